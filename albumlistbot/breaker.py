@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import deque
+
+import flask
+
+from albumlistbot import metrics
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """
+    Tracks recent outcomes of calls to one albumlist
+
+    Opens when enough of the recent calls failed (timeouts, connection
+    errors, 5xx), fails fast while open, then lets a single trial call
+    through after reset_seconds to decide whether to close again.
+    """
+    def __init__(self, name, window=20, threshold=5, rate=0.5, reset_seconds=30.0):
+        self.name = name
+        self.threshold = threshold
+        self.rate = rate
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.trial_started = 0.0
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == HALF_OPEN and (
+                not self.trial_in_flight
+                or time.monotonic() - self.trial_started >= self.reset_seconds
+            ):
+                # one trial at a time (a trial that never reported back is retried)
+                self.trial_in_flight = True
+                self.trial_started = time.monotonic()
+                return True
+        metrics.incr('breaker.rejected')
+        return False
+
+    def record_success(self):
+        with self._lock:
+            self._outcomes.append(True)
+            if self.state != CLOSED:
+                self.state = CLOSED
+                self._outcomes.clear()
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+            if self.state == HALF_OPEN:
+                self._open()
+                return
+            failures = self._outcomes.count(False)
+            if self.state == CLOSED and failures >= self.threshold and failures / len(self._outcomes) >= self.rate:
+                self._open()
+
+    def record_response(self, response):
+        if response.status_code >= 500:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.trial_in_flight = False
+        metrics.incr('breaker.opened')
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(app_url):
+    with _breakers_lock:
+        if app_url not in _breakers:
+            config = flask.current_app.config
+            breaker = CircuitBreaker(
+                app_url,
+                window=config['BREAKER_WINDOW'],
+                threshold=config['BREAKER_FAILURE_THRESHOLD'],
+                rate=config['BREAKER_FAILURE_RATE'],
+                reset_seconds=config['BREAKER_RESET_SECONDS'])
+            _breakers[app_url] = breaker
+            metrics.register_gauge('breaker.state', lambda: breaker.state, app=app_url)
+        return _breakers[app_url]
@@ -0,0 +1,107 @@
+import fnmatch
+import threading
+from contextlib import contextmanager
+
+from albumlistbot import metrics
+
+
+class Bulkhead(object):
+    """
+    Non-blocking concurrency limit: callers over the limit are rejected
+    """
+    def __init__(self, name, limit, label=None):
+        self.name = name
+        self.limit = limit
+        self.label = label or name
+        self.in_use = 0
+        self._lock = threading.Lock()
+        if label is None:
+            metrics.register_gauge('bulkhead.in_use', lambda: self.in_use, bulkhead=name)
+            metrics.register_gauge('bulkhead.limit', lambda: self.limit, bulkhead=name)
+
+    def acquire(self):
+        with self._lock:
+            if self.in_use >= self.limit:
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
+
+
+_bulkheads = {}
+_bulkheads_lock = threading.Lock()
+
+
+def _get_bulkhead(name, limit):
+    """
+    Names like 'team:T123' share the metric label 'team' rather than
+    reporting a gauge per team (call with _bulkheads_lock held)
+    """
+    if name not in _bulkheads:
+        label, sep, _ = name.partition(':')
+        _bulkheads[name] = Bulkhead(name, limit, label=label if sep else None)
+    return _bulkheads[name]
+
+
+def acquire(name, limit):
+    """
+    Take a slot in the named bulkhead, returning it (or None when full)
+    """
+    with _bulkheads_lock:
+        bulkhead = _get_bulkhead(name, limit)
+        if not bulkhead.acquire():
+            metrics.incr('bulkhead.rejected', bulkhead=bulkhead.label)
+            return None
+        return bulkhead
+
+
+def release(bulkhead):
+    """
+    Give a slot back, forgetting per-team bulkheads once they are idle so
+    the registry doesn't grow with every team seen
+    """
+    with _bulkheads_lock:
+        bulkhead.release()
+        if bulkhead.label != bulkhead.name and not bulkhead.in_use:
+            _bulkheads.pop(bulkhead.name, None)
+
+
+def parse_limits(limits):
+    """
+    'process_*:2,create:1' -> {'process_*': 2, 'create': 1}
+    """
+    parsed = {}
+    for item in limits.split(','):
+        if ':' in item:
+            pattern, limit = item.rsplit(':', 1)
+            parsed[pattern.strip()] = int(limit)
+    return parsed
+
+
+def command_limit(command, limits):
+    for pattern, limit in parse_limits(limits).items():
+        if fnmatch.fnmatchcase(command, pattern):
+            return pattern, limit
+    return None, None
+
+
+@contextmanager
+def bulkheads(*limits):
+    """
+    Acquire each (name, limit) bulkhead, yielding False if any is full
+    """
+    acquired = []
+    try:
+        for name, limit in limits:
+            bulkhead = acquire(name, limit)
+            if bulkhead is None:
+                yield False
+                return
+            acquired.append(bulkhead)
+        yield True
+    finally:
+        for bulkhead in acquired:
+            release(bulkhead)
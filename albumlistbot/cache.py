@@ -0,0 +1,85 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+
+_caches = weakref.WeakSet()
+
+
+def evict_team(team):
+    for cache in list(_caches):
+        cache.evict_team(team)
+
+
+def clear_all():
+    for cache in list(_caches):
+        cache.clear()
+
+
+class TTLCache(object):
+    """
+    Small thread-safe in-process cache with per-entry expiry
+
+    Entries may be tagged with a team id so that everything known about
+    a team can be dropped at once when its mapping changes.
+    """
+    def __init__(self, name, ttl, maxsize=1024):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._teams = {}
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, team, value = self._data[key]
+            except KeyError:
+                return default
+            if expires < time.monotonic():
+                self._pop(key)
+                return default
+            return value
+
+    def set(self, key, value, team=None, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (expires, team, value)
+            if team is not None:
+                self._teams.setdefault(team, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._pop(next(iter(self._data)))
+        return value
+
+    def evict(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def evict_team(self, team):
+        with self._lock:
+            for key in list(self._teams.get(team, ())):
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._teams.clear()
+
+    def _pop(self, key):
+        try:
+            _, team, _ = self._data.pop(key)
+        except KeyError:
+            return
+        if team is not None:
+            keys = self._teams.get(team)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._teams[team]
@@ -3,5 +3,8 @@ import re
 from albumlistbot import constants
 
 
+URL_PATTERN = re.compile(constants.URL_REGEX)
+
+
 def scrape_links_from_text(text):
-    return [url for url in re.findall(constants.URL_REGEX, text)]
\ No newline at end of file
+    return URL_PATTERN.findall(text)
\ No newline at end of file
@@ -0,0 +1,83 @@
+import functools
+import re
+
+import flask
+
+from albumlistbot import constants
+from albumlistbot.controllers import URL_PATTERN
+from albumlistbot.models import DatabaseError, mapping
+
+
+HASHTAG_PATTERN = re.compile(constants.HASHTAG_REGEX)
+MESSAGE_RULES = {
+    'message:links': URL_PATTERN,
+    'message:hashtags': HASHTAG_PATTERN,
+}
+
+
+@functools.lru_cache(maxsize=256)
+def parse_event_filter(spec):
+    """
+    'message:links,reaction_added' -> ({'reaction_added'}, [URL_PATTERN])
+
+    '*' accepts every event; unknown message rules raise ValueError.
+    """
+    types, patterns = set(), []
+    for item in (i.strip() for i in spec.split(',')):
+        if not item:
+            continue
+        if item.startswith('message:'):
+            try:
+                patterns.append(MESSAGE_RULES[item])
+            except KeyError:
+                raise ValueError(f'unknown message rule: {item}')
+        else:
+            types.add(item)
+    return frozenset(types), tuple(patterns)
+
+
+def message_text(event):
+    if event.get('subtype') == 'message_changed':
+        return event.get('message', {}).get('text', '')
+    return event.get('text', '')
+
+
+def should_forward(json_data, spec):
+    """
+    Whether an Events API payload passes a team's event filter
+    """
+    if json_data.get('type') != 'event_callback':
+        return True
+    types, patterns = parse_event_filter(spec)
+    if '*' in types:
+        return True
+    event = json_data.get('event', {})
+    event_type = event.get('type')
+    if event_type in types:
+        return True
+    if event_type == 'message':
+        text = message_text(event)
+        return any(pattern.search(text) for pattern in patterns)
+    return False
+
+
+def albumlist_events(team_id, form_data, *args, **kwargs):
+    spec = form_data['text'].strip().replace(' ', ',')
+    if not spec:
+        try:
+            current = mapping.get_app_and_event_filter_for_team(team_id)[1]
+        except DatabaseError as e:
+            flask.current_app.logger.error(f'[db]: {e}')
+            return 'Failed'
+        return current or f"{flask.current_app.config['EVENT_FILTER_DEFAULT']} (default)"
+    if spec == 'default':
+        spec = ''
+    try:
+        parse_event_filter(spec)
+        mapping.set_event_filter_for_team(team_id, spec)
+    except ValueError as e:
+        return f'Failed ({e}; rules: {", ".join(MESSAGE_RULES)})'
+    except DatabaseError as e:
+        flask.current_app.logger.error(f'[db]: {e}')
+        return 'Failed'
+    return f':white_check_mark: {spec or "default"}'
@@ -1,11 +1,34 @@
+import functools
+import os
+import re
+import threading
+import time
 from urllib.parse import urljoin, urlparse
 
 import flask
 import requests
 
-from albumlistbot import constants
-from albumlistbot.controllers import scrape_links_from_text
-from albumlistbot.models import DatabaseError, mapping
+from albumlistbot import breaker, cache, constants, logs, metrics, tasks
+from albumlistbot.controllers import scrape_links_from_text, slack
+from albumlistbot.models import DatabaseError, autoscale, mapping
+from albumlistbot.models.backends import get_backend
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Keep-alive session shared by Heroku API calls in this process
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            _session_pid = os.getpid()
+        return _session
 
 
 def set_heroku_headers(heroku_token):
@@ -22,19 +45,28 @@ def is_managed(team_id, app_url_or_name, heroku_token, session=requests):
     url = f"{urljoin(constants.HEROKU_API_URL, 'apps')}/{app_name}"
     headers = set_heroku_headers(heroku_token)
     response = session.get(url, headers=headers, timeout=1.5)
-    flask.current_app.logger.debug(f'[heroku][{response.status_code}]: {response.json()}')
+    logs.debug('[heroku]: app lookup', app=app_name, status=response.status_code, body=response.json)
     if response.status_code == 401:
         flask.current_app.logger.info(f'[heroku]: heroku auth failed...')
         return refresh_heroku(team_id, session)
     return heroku_token
 
 
+def get_managed_token(team_id, app_url_or_name, heroku_token, session=requests, **kwargs):
+    """
+    Use the result of an is_managed check already made during dispatch, if any
+    """
+    if 'managed_heroku_token' in kwargs:
+        return kwargs['managed_heroku_token']
+    return is_managed(team_id, app_url_or_name, heroku_token, session=session)
+
+
 def create_albumlist(team_id, app_url, slack_token, heroku_token, *args, **kwargs):
     if not heroku_token:
         return 'Missing Heroku OAuth'
     if not app_url:
-        with requests.Session() as s:
-            app_name = create_new_albumlist(team_id, slack_token, heroku_token, s)
+        s = get_session()
+        app_name = create_new_albumlist(team_id, slack_token, heroku_token, s)
         if not app_name:
             return 'Failed'
         try:
@@ -97,7 +129,7 @@ def create_new_albumlist(team_id, slack_token, heroku_token, session=requests):
     }
     response = session.post(url, headers=headers, json=payload)
     response_json = response.json()
-    flask.current_app.logger.debug(f'[heroku]: {response_json}')
+    logs.debug('[heroku]: app-setup', team=team_id, status=response.status_code, body=response_json)
     if response.status_code == 401:
         heroku_token = refresh_heroku(team_id, session)
         if not heroku_token:
@@ -105,7 +137,7 @@ def create_new_albumlist(team_id, slack_token, heroku_token, session=requests):
         headers = set_heroku_headers(heroku_token)
         response = session.post(url, headers=headers, json=payload)
         response_json = response.json()
-        flask.current_app.logger.debug(f'[heroku]: {response_json}')
+        logs.debug('[heroku]: app-setup', team=team_id, status=response.status_code, body=response_json)
     if response.ok:
         app_name = response_json['app']['name']
         flask.current_app.logger.info(f'[heroku]: created {app_name}')
@@ -121,7 +153,7 @@ def set_config_variables_for_albumlist(app_url_or_name, heroku_token, config_dic
     headers = set_heroku_headers(heroku_token)
     response = session.patch(url, headers=headers, json=config_dict)
     if response.ok:
-        flask.current_app.logger.info(f'[heroku]: updated config variables {app_url_or_name}: {response.json()}')
+        logs.info('[heroku]: updated config variables', app=app_url_or_name, keys=lambda: sorted(config_dict))
         return
     flask.current_app.logger.error(f'[heroku]: failed to update config variables for {app_url_or_name}: {response.status_code}')
 
@@ -134,34 +166,35 @@ def get_config_variable_for_albumlist(app_url_or_name, heroku_token, config_name
     headers = set_heroku_headers(heroku_token)
     response = session.get(url, headers=headers)
     if response.ok:
-        flask.current_app.logger.info(f'[heroku]: retrieved config variables {app_url_or_name}: {response.json()}')
-        return response.json()[config_name]
+        config_vars = response.json()
+        logs.info('[heroku]: retrieved config variables', app=app_url_or_name, keys=lambda: sorted(config_vars))
+        return config_vars[config_name]
     flask.current_app.logger.error(f'[heroku]: failed to retrieve config variables for {app_url_or_name}: {response.status_code}')
 
 
 def albumlist_name(team_id, app_url, form_data, heroku_token, *args, **kwargs):
     name = form_data['text'].strip()
-    with requests.Session() as s:
-        heroku_token = is_managed(team_id, app_url, heroku_token, session=s)
-        if heroku_token:
-            if name:
-                set_config_variables_for_albumlist(app_url, heroku_token, {'LIST_NAME': name}, session=s)
-                return f':white_check_mark: {name}'
-            else:
-                return get_config_variable_for_albumlist(app_url, heroku_token, 'LIST_NAME', session=s)
+    s = get_session()
+    heroku_token = get_managed_token(team_id, app_url, heroku_token, session=s, **kwargs)
+    if heroku_token:
+        if name:
+            set_config_variables_for_albumlist(app_url, heroku_token, {'LIST_NAME': name}, session=s)
+            return f':white_check_mark: {name}'
+        else:
+            return get_config_variable_for_albumlist(app_url, heroku_token, 'LIST_NAME', session=s)
     return 'Failed'
 
 
 def check_and_update(team_id, app_name, heroku_token):
     try:
-        with requests.Session() as s:
-            heroku_token = is_managed(team_id, app_name, heroku_token, session=s)
-            if not heroku_token:
-                return False
-            url = urljoin(constants.HEROKU_API_URL, f'apps/{app_name}/dynos')
-            headers = set_heroku_headers(heroku_token)
-            flask.current_app.logger.info(f'[heroku]: checking status of {app_name} dynos for {team_id}')
-            response = s.get(url, headers=headers, timeout=1.5)
+        s = get_session()
+        heroku_token = is_managed(team_id, app_name, heroku_token, session=s)
+        if not heroku_token:
+            return False
+        url = urljoin(constants.HEROKU_API_URL, f'apps/{app_name}/dynos')
+        headers = set_heroku_headers(heroku_token)
+        flask.current_app.logger.info(f'[heroku]: checking status of {app_name} dynos for {team_id}')
+        response = s.get(url, headers=headers, timeout=1.5)
     except requests.exceptions.Timeout:
         flask.current_app.logger.error(f'[heroku]: API timed out')
         return False
@@ -169,7 +202,7 @@ def check_and_update(team_id, app_name, heroku_token):
         return False
     flask.current_app.logger.info(f'[heroku]: app {app_name} is deployed')
     dynos = response.json()
-    flask.current_app.logger.debug(f'[heroku]: {dynos}')
+    logs.debug('[heroku]: dynos', app=app_name, dynos=dynos)
     if dynos and all(dyno['state'] == 'up' for dyno in dynos):
         app_url = f'https://{app_name}.herokuapp.com'
         flask.current_app.logger.info(f'[heroku]: registering {team_id} with {app_url}')
@@ -189,10 +222,13 @@ def check_albumlist(team_id, app_url, heroku_token, *args, **kwargs):
         return 'No albumlist mapped to this team (admins: use `/albumlist create` to get started)'
     if scrape_links_from_text(app_url):
         flask.current_app.logger.info(f'[router]: checking connection to {app_url} for {team_id}')
+        circuit = breaker.get_breaker(app_url)
         try:
             response = requests.head(app_url, timeout=2.0)
         except requests.exceptions.Timeout:
+            circuit.record_failure()
             return 'The connection to the albumlist timed out'
+        circuit.record_response(response)
         if response.ok:
             return 'OK'
         flask.current_app.logger.info(f'[router]: connection to {app_url} failed: {response.status_code}')
@@ -204,6 +240,37 @@ def check_albumlist(team_id, app_url, heroku_token, *args, **kwargs):
     return 'Failed. (admins: try running `/albumlist check` again)'
 
 
+_recent_checks = cache.TTLCache('recent_checks', ttl=30, maxsize=4096)
+_inflight_checks = {}
+_inflight_lock = threading.Lock()
+
+
+def schedule_check_albumlist(team_id, app_url, heroku_token):
+    """
+    Run check_albumlist in the background, coalescing concurrent requests
+    for the same albumlist into a single check, and recent ones into the
+    last successful check (a failed check can be retried straight away)
+    """
+    key = app_url or team_id
+    ttl = flask.current_app.config['PING_COALESCE_SECONDS']
+    with _inflight_lock:
+        if key in _inflight_checks:
+            return _inflight_checks[key]
+        if _recent_checks.get(key) is not None:
+            return
+        future = tasks.submit(check_albumlist, team_id, app_url, heroku_token)
+        _inflight_checks[key] = future
+
+    def finished(future):
+        with _inflight_lock:
+            _inflight_checks.pop(key, None)
+            if not future.cancelled() and future.exception() is None and future.result() == 'OK':
+                _recent_checks.set(key, future.result(), team=team_id, ttl=ttl)
+
+    future.add_done_callback(finished)
+    return future
+
+
 def auth_heroku(team_id, *args, **kwargs):
     url = constants.HEROKU_AUTH_URL.format(
         client_id=flask.current_app.config['HEROKU_CLIENT_ID'],
@@ -246,7 +313,9 @@ def refresh_heroku(team_id, session=requests):
         return
     access_token = response_json['access_token']
     try:
-        mapping.set_heroku_token_for_team(team_id, access_token)
+        if not mapping.set_heroku_token_for_team(team_id, access_token):
+            flask.current_app.logger.error(f'[heroku]: {team_id} is not registered')
+            return
     except DatabaseError as e:
         flask.current_app.logger.error(f'[db]: {e}')
         return
@@ -256,50 +325,224 @@ def refresh_heroku(team_id, session=requests):
 
 def scale_workers(team_id, app_url, form_data, heroku_token, *args, **kwargs):
     quantity = form_data['text'].strip()
-    with requests.Session() as s:
-        heroku_token = is_managed(team_id, app_url, heroku_token, session=s)
-        if heroku_token:
-            return scale_formation(app_url, heroku_token, quantity=quantity, session=s)
+    s = get_session()
+    heroku_token = get_managed_token(team_id, app_url, heroku_token, session=s, **kwargs)
+    if heroku_token:
+        return scale_formation(app_url, heroku_token, quantity=quantity, session=s)
     return 'Failed'
 
 
-def scale_formation(app_url_or_name, heroku_token, quantity=None, session=requests):
+def get_app_name(app_url_or_name):
     if scrape_links_from_text(app_url_or_name):
-        app_url_or_name = urlparse(app_url_or_name).hostname.split('.')[0]
+        return urlparse(app_url_or_name).hostname.split('.')[0]
+    return app_url_or_name
+
+
+def formation_updates(quantity):
+    """
+    Formation for quantity workers (hobby dynos can't scale past one, and
+    can't be mixed with standard ones, so web moves tier with the workers,
+    restarting it)
+    """
+    size = "standard-1X" if quantity > 1 else "hobby"
+    return [
+        {"quantity": 1, "size": size, "type": "web"},
+        {"quantity": quantity, "size": size, "type": "worker"},
+    ]
+
+
+def scale_formation(app_url_or_name, heroku_token, quantity=None, session=requests):
+    app_url_or_name = get_app_name(app_url_or_name)
     url = f"{urljoin(constants.HEROKU_API_URL, 'apps')}/{app_url_or_name}/formation"
     headers = set_heroku_headers(heroku_token)
+    timeout = flask.current_app.config['HEROKU_TIMEOUT']
     try:
-        quantity = int(quantity)
-        flask.current_app.logger.info(f'[heroku]: scaling dyno formation to {quantity} for {app_url_or_name}...')
-        payload = {"updates": [
-            {
-                "quantity": 1,
-                "size": "standard-1X" if quantity > 1 else "hobby",
-                "type": "web"
-            },
-            {
-                "quantity": quantity,
-                "size": "standard-1X" if quantity > 1 else "hobby",
-                "type": "worker"
-            },
-        ]}
-        response = session.patch(url, headers=headers, json=payload)
-    except ValueError:
-        response = session.get(url, headers=headers)
+        try:
+            quantity = int(quantity)
+            flask.current_app.logger.info(f'[heroku]: scaling dyno formation to {quantity} for {app_url_or_name}...')
+            response = session.patch(url, headers=headers, json={"updates": formation_updates(quantity)}, timeout=timeout)
+        except ValueError:
+            response = session.get(url, headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        flask.current_app.logger.error(f'[heroku]: failed to scale formation for {app_url_or_name}: {e}')
+        return ':red_circle: failed to scale'
     if response.ok:
         response_json = response.json()
-        flask.current_app.logger.debug(f'[heroku]: current scale for {app_url_or_name}: {response_json}')
+        logs.debug('[heroku]: current scale', app=app_url_or_name, formation=response_json)
         return "\n".join([f"{dyno['quantity']} x {dyno['type']} ({dyno['size']})" for dyno in response_json])
     flask.current_app.logger.error(f'[heroku]: failed to scale formation for {app_url_or_name}: {response.status_code}')
-    flask.current_app.logger.debug(f'[heroku]: {response.text}')
-    return f':red_circle: failed to scale'
-
-
-"""
-TODO:
--> process check
-<- send command
-<- scale formation
--> process complete
-<- scale formation
-"""
+    logs.debug('[heroku]: formation response', app=app_url_or_name, body=lambda: response.text)
+    return ':red_circle: failed to scale'
+
+
+def get_formation(app_url_or_name, heroku_token, session=requests):
+    """
+    The app's current formation as a list of updates that would restore it
+    (None if it couldn't be read)
+    """
+    app_name = get_app_name(app_url_or_name)
+    url = f"{urljoin(constants.HEROKU_API_URL, 'apps')}/{app_name}/formation"
+    try:
+        response = session.get(url, headers=set_heroku_headers(heroku_token), timeout=flask.current_app.config['HEROKU_TIMEOUT'])
+    except requests.exceptions.RequestException as e:
+        flask.current_app.logger.error(f'[heroku]: failed to read formation for {app_name}: {e}')
+        return
+    if not response.ok:
+        flask.current_app.logger.error(f'[heroku]: failed to read formation for {app_name}: {response.status_code}')
+        return
+    return [{'quantity': dyno['quantity'], 'size': dyno['size'], 'type': dyno['type']} for dyno in response.json()]
+
+
+def update_formation(app_url_or_name, heroku_token, updates, session=requests):
+    """
+    PATCH the app's formation, returning whether Heroku accepted it
+    """
+    app_name = get_app_name(app_url_or_name)
+    url = f"{urljoin(constants.HEROKU_API_URL, 'apps')}/{app_name}/formation"
+    try:
+        response = session.patch(
+            url, headers=set_heroku_headers(heroku_token), json={'updates': updates},
+            timeout=flask.current_app.config['HEROKU_TIMEOUT'])
+    except requests.exceptions.RequestException as e:
+        flask.current_app.logger.error(f'[heroku]: failed to update formation for {app_name}: {e}')
+        return False
+    if not response.ok:
+        flask.current_app.logger.error(f'[heroku]: failed to update formation for {app_name}: {response.status_code}')
+        logs.debug('[heroku]: formation response', app=app_name, body=lambda: response.text)
+        return False
+    return True
+
+
+def is_process_complete(team_id, app_url, form_data):
+    check_data = dict(form_data)
+    check_data['text'] = ''
+    full_url = f'{urljoin(app_url, "slack")}/process/check'
+    try:
+        response = requests.post(full_url, data=check_data, timeout=5.0)
+    except requests.exceptions.RequestException as e:
+        flask.current_app.logger.error(f'[heroku]: process check failed for {team_id}: {e}')
+        return False
+    if not response.ok:
+        return False
+    try:
+        text = response.json().get('text', '')
+    except ValueError:
+        text = response.text
+    return bool(re.search(flask.current_app.config['PROCESS_IDLE_REGEX'], text, re.IGNORECASE))
+
+
+def scale_up(team_id, app_url, heroku_token, form_data, session=requests):
+    """
+    Scale workers up unless another command already has, recording the
+    formation to restore once processing finishes
+    """
+    config = flask.current_app.config
+    formation = get_formation(app_url, heroku_token, session=session)
+    try:
+        if not autoscale.add_watch(app_url, team_id, formation, form_data, config['PROCESS_SCALE_TIMEOUT']):
+            return
+    except DatabaseError as e:
+        flask.current_app.logger.error(f'[db]: {e}')
+        return
+    if update_formation(app_url, heroku_token, formation_updates(config['PROCESS_SCALE_UP']), session=session):
+        metrics.incr('autoscale.up')
+        return
+    metrics.incr('autoscale.failed', direction='up')
+    try:
+        autoscale.remove_watch(app_url)
+    except DatabaseError as e:
+        flask.current_app.logger.error(f'[db]: {e}')
+
+
+def scale_down(team_id, app_url, formation, attempts):
+    """
+    Put the formation back as it was before scaling up, retrying on later
+    checks (up to PROCESS_SCALE_RETRIES times) if Heroku refuses
+    """
+    config = flask.current_app.config
+    updates = formation or formation_updates(config['PROCESS_SCALE_DOWN'])
+    heroku_token = is_managed(team_id, app_url, mapping.get_heroku_token_for_team(team_id), session=get_session())
+    if heroku_token and update_formation(app_url, heroku_token, updates, session=get_session()):
+        metrics.incr('autoscale.down')
+        autoscale.remove_watch(app_url)
+        return
+    metrics.incr('autoscale.failed', direction='down')
+    if attempts + 1 >= config['PROCESS_SCALE_RETRIES']:
+        flask.current_app.logger.error(f'[heroku]: giving up scaling {app_url} back down for {team_id}')
+        autoscale.remove_watch(app_url)
+    else:
+        autoscale.record_attempt(app_url)
+
+
+def check_watch(app_url, team_id, formation, form_data, expired, attempts):
+    if expired:
+        flask.current_app.logger.error(f'[heroku]: processing timed out for {team_id}')
+    elif is_process_complete(team_id, app_url, form_data):
+        flask.current_app.logger.info(f'[heroku]: processing complete for {team_id}')
+    else:
+        return
+    scale_down(team_id, app_url, formation, attempts)
+
+
+def run_watcher():
+    """
+    Check scaled-up apps every PROCESS_CHECK_INTERVAL, wherever they were
+    scaled from (each app is leased to one worker per interval)
+    """
+    interval = flask.current_app.config['PROCESS_CHECK_INTERVAL']
+    while True:
+        time.sleep(interval)
+        try:
+            for row in autoscale.claim_due_watches(interval):
+                check_watch(*row)
+        except DatabaseError as e:
+            flask.current_app.logger.error(f'[db]: {e}')
+        except Exception:
+            flask.current_app.logger.exception('[heroku]: autoscale check failed')
+
+
+def start_watcher(app):
+    with app.app_context():
+        return tasks.spawn(run_watcher)
+
+
+def start_scaled_process(team_id, app_url, form_data, heroku_token, uri, **kwargs):
+    """
+    Send the process command, then scale up if the albumlist took it (the
+    resize restarts its web dyno, which would lose a command sent after)
+    """
+    response = slack.route_commands_to_albumlist(team_id, app_url, uri, form_data)
+    slack.respond(form_data, response)
+    if isinstance(response, str) and response.startswith(slack.ROUTE_FAILURES):
+        return
+    try:
+        s = get_session()
+        heroku_token = get_managed_token(team_id, app_url, heroku_token, session=s, **kwargs)
+        if heroku_token:
+            scale_up(team_id, app_url, heroku_token, form_data, session=s)
+    except Exception:
+        metrics.incr('autoscale.failed', direction='up')
+        flask.current_app.logger.exception(f'[heroku]: failed to scale up for {team_id}')
+
+
+def route_process_with_scaling(team_id, app_url, form_data, heroku_token, uri, *args, **kwargs):
+    """
+    Acknowledge, then send the process command and scale workers up in the
+    background; the watcher scales back down once processing finishes.
+    Unmanaged albumlists, and all albumlists when watches can't be kept
+    (on backends other than postgres), are routed as before.
+    """
+    if (not flask.current_app.config['PROCESS_AUTOSCALE'] or get_backend().name != 'postgres'
+            or not heroku_token or not form_data.get('response_url')):
+        return slack.route_commands_to_albumlist(team_id, app_url, uri, form_data)
+    tasks.submit(start_scaled_process, team_id, app_url, dict(form_data), heroku_token, uri, **kwargs)
+    return 'Scaling up workers and starting processing...'
+
+
+process_albums = functools.partial(route_process_with_scaling, uri='process')
+process_attribution = functools.partial(route_process_with_scaling, uri='process/attribution')
+process_covers = functools.partial(route_process_with_scaling, uri='process/covers')
+process_duplicates = functools.partial(route_process_with_scaling, uri='process/duplicates')
+process_released = functools.partial(route_process_with_scaling, uri='process/released')
+process_tags = functools.partial(route_process_with_scaling, uri='process/tags')
+process_unavailable = functools.partial(route_process_with_scaling, uri='process/unavailable')
@@ -0,0 +1,274 @@
+import csv
+import hashlib
+import io
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import flask
+import requests
+
+from albumlistbot import breaker, metrics, tasks
+from albumlistbot.controllers import scrape_links_from_text, slack
+
+
+# status codes meaning the albumlist has no chunked restore endpoint
+UNSUPPORTED_STATUSES = (404, 405, 501)
+# slack accepts five messages per response_url, one is kept for the result
+MAX_PROGRESS_MESSAGES = 3
+
+_restores = {}
+_restores_lock = threading.Lock()
+
+
+class ChunksUnsupported(Exception):
+    pass
+
+
+class RestoreLimitExceeded(Exception):
+    pass
+
+
+class Restore(object):
+    """
+    Progress of one restore, shared between the reader and chunk senders
+    """
+    def __init__(self, team_id, app_url, csv_url, response_url):
+        self.id = uuid.uuid4().hex
+        self.team_id = team_id
+        self.app_url = app_url
+        self.csv_url = csv_url
+        self.response_url = response_url
+        self.header = None
+        self.rows = 0
+        self.sent = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.lock = threading.Lock()
+        self.progress_messages = 0
+        self.last_progress = time.monotonic()
+
+
+class LimitedReader(io.RawIOBase):
+    """
+    Raw stream failing once more than max_bytes have been read from it, or
+    once it is read from after the deadline (a time.monotonic() value)
+    """
+    def __init__(self, raw, max_bytes, deadline):
+        self.raw = raw
+        self.max_bytes = max_bytes
+        self.deadline = deadline
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if time.monotonic() > self.deadline:
+            raise RestoreLimitExceeded('the CSV took too long to download')
+        data = self.raw.read(len(buffer))
+        self.count += len(data)
+        if self.count > self.max_bytes:
+            raise RestoreLimitExceeded(f'the CSV is larger than {self.max_bytes} bytes')
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def read_rows(response, max_bytes, deadline):
+    """
+    Parse CSV rows as they arrive, without holding the whole file
+    """
+    response.raw.decode_content = True
+    stream = io.BufferedReader(LimitedReader(response.raw, max_bytes, deadline))
+    return csv.reader(io.TextIOWrapper(stream, encoding='utf-8', errors='replace', newline=''))
+
+
+def clean_rows(rows, restore, max_seen):
+    """
+    Take the first row as the header, then skip blank rows, rows whose
+    width differs from the header, and duplicates
+
+    Duplicates are found among the last max_seen distinct rows, each
+    remembered by an 8-byte digest, so memory stays bounded however large
+    the file; repeats further apart than that are left to the albumlist.
+    """
+    seen = OrderedDict()
+    width = None
+    for row in rows:
+        if not row or not any(field.strip() for field in row):
+            restore.invalid += 1
+            continue
+        if width is None:
+            restore.header = row
+            width = len(row)
+            continue
+        restore.rows += 1
+        if len(row) != width:
+            restore.invalid += 1
+            continue
+        digest = hashlib.blake2b('\x1f'.join(row).encode('utf-8'), digest_size=8).digest()
+        if digest in seen:
+            seen.move_to_end(digest)
+            restore.duplicates += 1
+            continue
+        seen[digest] = None
+        if len(seen) > max_seen:
+            seen.popitem(last=False)
+        yield row
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def send_chunk(restore, index, chunk):
+    full_url = urljoin(restore.app_url, 'slack/restore/chunk')
+    payload = {
+        'token': flask.current_app.config['APP_TOKEN'],
+        'team_id': restore.team_id,
+        'restore_id': restore.id,
+        'chunk': index,
+        'header': restore.header,
+        'rows': chunk,
+    }
+    circuit = breaker.get_breaker(restore.app_url)
+    try:
+        response = requests.post(full_url, json=payload, timeout=flask.current_app.config['RESTORE_TIMEOUT'])
+    except requests.exceptions.RequestException:
+        circuit.record_failure()
+        raise
+    if index == 0 and response.status_code in UNSUPPORTED_STATUSES:
+        raise ChunksUnsupported(response.status_code)
+    circuit.record_response(response)
+    response.raise_for_status()
+    with restore.lock:
+        restore.sent += len(chunk)
+    metrics.incr('restore.chunks')
+
+
+def report(restore, text):
+    if not restore.response_url:
+        return
+    try:
+        requests.post(restore.response_url, json={'response_type': 'ephemeral', 'text': text}, timeout=5)
+    except requests.exceptions.RequestException as e:
+        flask.current_app.logger.error(f'[restore]: failed to report progress for {restore.team_id}: {e}')
+
+
+def report_progress(restore):
+    interval = flask.current_app.config['RESTORE_PROGRESS_SECONDS']
+    if restore.progress_messages >= MAX_PROGRESS_MESSAGES or time.monotonic() - restore.last_progress < interval:
+        return
+    restore.progress_messages += 1
+    restore.last_progress = time.monotonic()
+    report(restore, f'Restoring... {restore.sent} rows sent so far')
+
+
+def push_chunks(restore, chunks):
+    """
+    Send the first chunk alone (to find out whether the albumlist takes
+    chunks at all), then the rest in parallel, holding back the reader
+    while RESTORE_PARALLELISM chunks are queued behind those in flight
+    """
+    config = flask.current_app.config
+    parallelism = config['RESTORE_PARALLELISM']
+    try:
+        first = next(chunks)
+    except StopIteration:
+        return
+    send_chunk(restore, 0, first)
+    slots = threading.BoundedSemaphore(parallelism * 2)
+    failures = []
+
+    def done(future):
+        slots.release()
+        if future.exception() is not None:
+            failures.append(future.exception())
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        for index, chunk in enumerate(chunks, start=1):
+            slots.acquire()
+            if failures:
+                slots.release()
+                break
+            future = executor.submit(tasks.in_app_context(send_chunk, restore, index, chunk))
+            future.add_done_callback(done)
+            report_progress(restore)
+    if failures:
+        raise failures[0]
+
+
+def forward_restore(restore, form_data):
+    """
+    Hand the whole restore to an albumlist without a chunk endpoint
+    """
+    flask.current_app.logger.info(f'[restore]: {restore.app_url} has no chunked restore, forwarding')
+    response = slack.route_commands_to_albumlist(restore.team_id, restore.app_url, 'restore_from_url', form_data)
+    report(restore, response if isinstance(response, str) else 'Restore sent to the albumlist')
+
+
+def run_restore(restore, form_data):
+    config = flask.current_app.config
+    started = time.monotonic()
+    try:
+        with requests.get(restore.csv_url, stream=True, timeout=config['RESTORE_TIMEOUT']) as response:
+            response.raise_for_status()
+            csv_rows = read_rows(response, config['RESTORE_MAX_BYTES'], started + config['RESTORE_MAX_SECONDS'])
+            rows = clean_rows(csv_rows, restore, config['RESTORE_DEDUPE_ROWS'])
+            chunks = chunked(rows, config['RESTORE_CHUNK_SIZE'])
+            push_chunks(restore, chunks)
+    except ChunksUnsupported:
+        forward_restore(restore, form_data)
+        return
+    except (requests.exceptions.RequestException, csv.Error, UnicodeError, RestoreLimitExceeded) as e:
+        flask.current_app.logger.error(f'[restore]: restore for {restore.team_id} failed: {e}')
+        metrics.incr('restore.failed')
+        report(restore, f'Failed to restore after {restore.sent} rows: {e}')
+        return
+    except Exception:
+        flask.current_app.logger.exception(f'[restore]: restore for {restore.team_id} failed')
+        metrics.incr('restore.failed')
+        report(restore, f'Failed to restore after {restore.sent} rows')
+        return
+    finally:
+        with _restores_lock:
+            _restores.pop(restore.app_url, None)
+    metrics.observe('restore.seconds', time.monotonic() - started)
+    report(restore, (
+        f'Restored {restore.sent} rows '
+        f'({restore.duplicates} duplicates and {restore.invalid} invalid rows skipped)'))
+
+
+def restore_from_url(team_id, app_url, form_data, *args, **kwargs):
+    """
+    Stream a remote CSV into the albumlist in the background, reporting
+    progress through the command's response_url
+    """
+    try:
+        csv_url = scrape_links_from_text(form_data['text'])[0]
+    except IndexError:
+        return 'Failed (usage: `/albumlist restore https://some-remote.csv`)'
+    if not app_url:
+        return 'Failed (use `/albumlist set [url]` first to use Albumlist commands)'
+    if not scrape_links_from_text(app_url):
+        return 'Failed (try `/albumlist check`)'
+    if not breaker.get_breaker(app_url).allow():
+        return 'The albumlist is not responding at the moment, try again shortly (admins: `/albumlist check`)'
+    restore = Restore(team_id, app_url, csv_url, form_data.get('response_url'))
+    with _restores_lock:
+        if app_url in _restores:
+            return 'A restore is already running for this albumlist'
+        _restores[app_url] = restore
+    flask.current_app.logger.info(f'[restore]: restoring {team_id} from {csv_url}')
+    tasks.spawn(run_restore, restore, form_data)
+    return f'Restoring from {csv_url}...'
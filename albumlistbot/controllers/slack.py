@@ -3,23 +3,36 @@ from urllib.parse import urljoin
 
 import flask
 import requests
-from slacker import Slacker
 
+from albumlistbot import breaker, prewarm, slack_client
 from albumlistbot.controllers import scrape_links_from_text
 from albumlistbot.models import mapping, DatabaseError
 
 
+# replies of route_commands_to_albumlist when the command wasn't delivered
+ROUTE_FAILURES = ('Failed', 'The connection', 'The albumlist')
+
+
 def route_commands_to_albumlist(team_id, app_url, uri, form_data, *args, **kwargs):
     if not app_url:
         return 'Failed (use `/albumlist set [url]` first to use Albumlist commands)'
     if not scrape_links_from_text(app_url):
         return 'Failed (try `/albumlist check`)'
     full_url = f'{urljoin(app_url, "slack")}/{uri}'
+    prewarm.record_activity(team_id)
+    circuit = breaker.get_breaker(app_url)
+    if not circuit.allow():
+        return 'The albumlist is not responding at the moment, try again shortly (admins: `/albumlist check`)'
     flask.current_app.logger.info(f'[router]: connecting {team_id} to {full_url}...')
     try:
         response = requests.post(full_url, data=form_data, timeout=2.0)
     except requests.exceptions.Timeout:
+        circuit.record_failure()
         return 'The connection to the albumlist timed out'
+    except requests.exceptions.ConnectionError:
+        circuit.record_failure()
+        return 'Failed to connect to the albumlist'
+    circuit.record_response(response)
     if not response.ok:
         flask.current_app.logger.error(f'[router]: connection error for {team_id} to {full_url}: {response.status_code}')
         return 'Failed'
@@ -29,18 +42,30 @@ def route_commands_to_albumlist(team_id, app_url, uri, form_data, *args, **kwarg
         return response.text
 
 
-def get_slack_team_url(token):
-    slack = Slacker(token)
+def respond(form_data, response):
+    """
+    Send a command's result to its response_url once it's finished in the
+    background
+    """
+    if isinstance(response, flask.Response):
+        message = response.get_json()
+    else:
+        message = {'response_type': 'ephemeral', 'text': response}
+    try:
+        requests.post(form_data['response_url'], json=message, timeout=5)
+    except requests.exceptions.RequestException as e:
+        flask.current_app.logger.error(f'[router]: failed to respond for {form_data.get("team_id")}: {e}')
+
+
+def get_slack_team_url(token, team_id=None):
     flask.current_app.logger.info(f'[router]: getting team info...')
-    info = slack.team.info()
-    return f"https://{info.body['team']['domain']}.slack.com"
+    info = slack_client.team_info(token, team_id)
+    return f"https://{info['domain']}.slack.com"
 
 
 def is_slack_admin(token, user_id):
-    slack = Slacker(token)
     flask.current_app.logger.info(f'[router]: performing admin check...')
-    info = slack.users.info(user_id)
-    return info.body['user']['is_admin']
+    return slack_client.user_info(token, user_id)['is_admin']
 
 
 def albumlist_url(app_url, team_id, form_data, *args, **kwargs):
@@ -122,6 +147,5 @@ process_released = functools.partial(route_commands_to_albumlist, uri='process/r
 process_tags = functools.partial(route_commands_to_albumlist, uri='process/tags')
 process_unavailable = functools.partial(route_commands_to_albumlist, uri='process/unavailable')
 clear_cache = functools.partial(route_commands_to_albumlist, uri='clear')
-restore_from_url = functools.partial(route_commands_to_albumlist, uri='restore_from_url')
 count_albums = functools.partial(route_commands_to_albumlist, uri='count')
 test_albumlist = functools.partial(route_commands_to_albumlist, uri='admin/check')
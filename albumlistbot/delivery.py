@@ -0,0 +1,158 @@
+import gzip
+import json
+import threading
+import time
+from urllib.parse import urljoin
+
+import flask
+import requests
+
+from albumlistbot import breaker, cache, metrics, outbox, tasks
+
+
+# status codes meaning the albumlist has no batch endpoint
+UNSUPPORTED_STATUSES = (404, 405, 415, 501)
+
+_batch_support = cache.TTLCache('batch_support', ttl=3600)
+_buffers = {}
+_condition = threading.Condition()
+_flusher = None
+
+
+class Batch(object):
+    """
+    Events waiting to be sent to one albumlist
+    """
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.events = []
+
+
+def supports_batches(app_url):
+    return _batch_support.get(app_url) is True
+
+
+def post_event(app_url, json_data):
+    """
+    Forward a single event to the albumlist, returning False when it
+    should be retried later
+    """
+    full_url = urljoin(app_url, 'slack/events')
+    circuit = breaker.get_breaker(app_url)
+    try:
+        response = requests.post(full_url, json=json_data, timeout=flask.current_app.config['EVENT_TIMEOUT'])
+    except requests.exceptions.RequestException as e:
+        circuit.record_failure()
+        flask.current_app.logger.error(f'[router]: connection error to {full_url}: {e}')
+        return False
+    circuit.record_response(response)
+    if not response.ok:
+        flask.current_app.logger.error(f'[router]: connection error to {full_url}: {response.status_code}')
+        if response.status_code < 500:
+            metrics.incr('events.rejected')
+    return response.status_code < 500
+
+
+def post_batch(app_url, events):
+    """
+    Send events as one gzipped JSON array, falling back to (and from then
+    on using) single delivery when the albumlist has no batch endpoint
+
+    Returns the events, in order, that still need delivering: all of them
+    unless the albumlist accepted the batch.
+    """
+    full_url = urljoin(app_url, 'slack/events/batch')
+    circuit = breaker.get_breaker(app_url)
+    body = gzip.compress(json.dumps(events).encode('utf-8'))
+    headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+    try:
+        response = requests.post(full_url, data=body, headers=headers, timeout=flask.current_app.config['EVENT_TIMEOUT'])
+    except requests.exceptions.RequestException as e:
+        circuit.record_failure()
+        metrics.incr('events.batch_failed')
+        flask.current_app.logger.error(f'[router]: connection error to {full_url}: {e}')
+        return events
+    if response.status_code in UNSUPPORTED_STATUSES:
+        flask.current_app.logger.info(f'[router]: {app_url} does not accept batches ({response.status_code})')
+        _batch_support.set(app_url, False)
+        for delivered, json_data in enumerate(events):
+            if not post_event(app_url, json_data):
+                return events[delivered:]
+        return []
+    circuit.record_response(response)
+    if not response.ok:
+        metrics.incr('events.batch_failed')
+        flask.current_app.logger.error(f'[router]: connection error to {full_url}: {response.status_code}')
+        return events
+    _batch_support.set(app_url, True)
+    metrics.incr('events.batches')
+    metrics.incr('events.batched', len(events))
+    return []
+
+
+def send_batch(app_url, events):
+    for json_data in post_batch(app_url, events):
+        outbox.store(app_url, json_data)
+
+
+def enqueue(app_url, json_data):
+    config = flask.current_app.config
+    with _condition:
+        batch = _buffers.get(app_url)
+        if batch is None:
+            batch = _buffers[app_url] = Batch(time.monotonic() + config['EVENT_BATCH_WAIT_MS'] / 1000.0)
+        batch.events.append(json_data)
+        if len(batch.events) >= config['EVENT_BATCH_SIZE']:
+            batch.deadline = 0
+        _condition.notify()
+
+
+def take_due(now, timeout=None):
+    """
+    Remove and return batches that are full or past their deadline,
+    waiting up to the earliest deadline when none are
+    """
+    with _condition:
+        due = [app_url for app_url, batch in _buffers.items() if batch.deadline <= now]
+        if not due:
+            if _buffers:
+                timeout = min(batch.deadline for batch in _buffers.values()) - now
+            _condition.wait(timeout)
+            return []
+        return [(app_url, _buffers.pop(app_url).events) for app_url in due]
+
+
+def run():
+    while True:
+        for app_url, events in take_due(time.monotonic()):
+            tasks.submit(send_batch, app_url, events)
+
+
+def deliver(app_url, json_data):
+    """
+    Forward an event, buffering it for a batch when EVENT_BATCHING is on
+    and the albumlist hasn't refused batches
+
+    Events for an albumlist that is unreachable, or that still has events
+    waiting in the outbox, go to the outbox.
+    """
+    if outbox.is_pending(app_url) or not breaker.get_breaker(app_url).allow():
+        outbox.store(app_url, json_data)
+    elif _flusher is None or _batch_support.get(app_url) is False:
+        if not post_event(app_url, json_data):
+            outbox.store(app_url, json_data)
+    else:
+        enqueue(app_url, json_data)
+
+
+def start_flusher(app):
+    """
+    Start this worker's batch flusher
+    """
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return _flusher
+    with app.app_context():
+        _flusher = tasks.spawn(run)
+    metrics.register_gauge('events.buffered', lambda: sum(len(batch.events) for batch in list(_buffers.values())))
+    return _flusher
@@ -0,0 +1,57 @@
+import logging
+import logging.handlers
+import random
+
+import flask
+
+
+class StructuredMessage(object):
+    """
+    Log message with key=value fields, formatted only when emitted
+
+    Callable field values are called at format time, so expensive
+    serialisation (e.g. response.json) is skipped for disabled levels.
+    """
+    def __init__(self, message, fields):
+        self.message = message
+        self.fields = fields
+
+    def __str__(self):
+        parts = [self.message]
+        for key, value in self.fields.items():
+            if callable(value):
+                try:
+                    value = value()
+                except Exception as e:
+                    value = f'<{e.__class__.__name__}>'
+            parts.append(f'{key}={value}')
+        return ' '.join(parts)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread
+    """
+    def prepare(self, record):
+        return record
+
+
+def log(level, message, sample=None, logger=None, **fields):
+    logger = logger or flask.current_app.logger
+    if not logger.isEnabledFor(level):
+        return
+    if sample is not None and random.random() >= sample:
+        return
+    logger.log(level, StructuredMessage(message, fields))
+
+
+def debug(message, sample=None, **fields):
+    log(logging.DEBUG, message, sample=sample, **fields)
+
+
+def info(message, sample=None, **fields):
+    log(logging.INFO, message, sample=sample, **fields)
+
+
+def error(message, sample=None, **fields):
+    log(logging.ERROR, message, sample=sample, **fields)
@@ -0,0 +1,54 @@
+import threading
+
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+_gauges = {}
+
+
+def key(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}={v}' for k, v in sorted(labels.items())) + '}'
+
+
+def incr(name, value=1, **labels):
+    k = key(name, labels)
+    with _lock:
+        _counters[k] = _counters.get(k, 0) + value
+
+
+def observe(name, seconds, **labels):
+    k = key(name, labels)
+    with _lock:
+        count, total, highest = _timings.get(k, (0, 0.0, 0.0))
+        _timings[k] = (count + 1, total + seconds, max(highest, seconds))
+
+
+def register_gauge(name, func, **labels):
+    """
+    Register a callable read whenever metrics are collected
+    """
+    with _lock:
+        _gauges[key(name, labels)] = func
+
+
+def unregister_gauge(name, **labels):
+    with _lock:
+        _gauges.pop(key(name, labels), None)
+
+
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        timings = dict(_timings)
+        gauges = dict(_gauges)
+    return {
+        'counters': counters,
+        'gauges': {k: func() for k, func in gauges.items()},
+        'timings': {
+            k: {'count': count, 'mean': total / count, 'max': highest}
+            for k, (count, total, highest) in timings.items()
+        },
+    }
@@ -1,35 +1,254 @@
 import os
-from contextlib import closing
+import threading
+import time
+from contextlib import closing, contextmanager
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from urllib.parse import urlparse
 
 
 # urlparse.uses_netloc.append("postgres")
 
-class DatabaseError(Exception): 
+class DatabaseError(Exception):
     pass
 
 
-def get_connection():
-    db_url = urlparse(os.environ['DATABASE_URL'])
+class Connection(psycopg2.extensions.connection):
+    """
+    Connection remembering which server-side statements it has prepared
+
+    Opened with the calling thread's connect_timeout override, if any.
+    """
+    def __init__(self, dsn, *args, **kwargs):
+        seconds = getattr(_state, 'connect_timeout', None)
+        if seconds is not None:
+            dsn = psycopg2.extensions.make_dsn(dsn, connect_timeout=max(int(seconds), 1))
+        super().__init__(dsn, *args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+def timeouts():
+    """
+    Connection arguments bounding how long connecting (seconds) and each
+    statement (milliseconds, 0 for no limit) may take, so a struggling
+    database fails fast enough for reads to fall back to the snapshot
+    """
+    statement_timeout = int(os.environ.get('DATABASE_STATEMENT_TIMEOUT', '5000'))
+    return {
+        'connect_timeout': int(os.environ.get('DATABASE_CONNECT_TIMEOUT', '3')),
+        'options': f'-c statement_timeout={statement_timeout}',
+    }
+
+
+@contextmanager
+def connect_timeout(seconds):
+    """
+    Give up on connections this thread opens, pooled or not, after seconds
+    """
+    _state.connect_timeout = seconds
+    try:
+        yield
+    finally:
+        _state.connect_timeout = None
+
+
+def connect(url):
+    db_url = urlparse(url)
     try:
         return psycopg2.connect(
             database=db_url.path[1:],
             user=db_url.username,
             password=db_url.password,
             host=db_url.hostname,
-            port=db_url.port
+            port=db_url.port,
+            connection_factory=Connection,
+            **timeouts()
         )
     except psycopg2.OperationalError as e:
         raise DatabaseError(e)
 
 
+def get_connection():
+    return connect(os.environ['DATABASE_URL'])
+
+
+def try_advisory_lock(conn, key):
+    """
+    Take the session-level advisory lock for key on conn without waiting,
+    returning whether it was taken (it's held until unlocked or closed)
+    """
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT pg_try_advisory_lock(hashtext(%s));', (key,))
+        return cur.fetchone()[0]
+    except psycopg2.Error as e:
+        raise DatabaseError(e)
+
+
+def get_pool_size():
+    return int(os.environ.get('DATABASE_POOL_SIZE', '5'))
+
+
+def is_usable(conn):
+    """
+    Whether a pooled connection is still open, pinging it when it has sat
+    idle long enough for the server or a proxy to have dropped it
+    """
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.last_used < float(os.environ.get('DATABASE_PING_SECONDS', '30')):
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT 1;')
+        conn.rollback()
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+
+
+class Pool(object):
+    """
+    Per-process pool of connections to one database URL
+
+    Falls back to a one-off connection when the pool is exhausted.
+    """
+    def __init__(self, url, maxconn):
+        self.url = url
+        self.maxconn = maxconn
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = psycopg2.pool.ThreadedConnectionPool(
+                    0, self.maxconn, self.url, connection_factory=Connection, **timeouts())
+                self._pid = os.getpid()
+            return self._pool
+
+    def getconn(self):
+        """
+        Check out a connection, discarding any that have gone stale
+        """
+        try:
+            pool = self._get_pool()
+            for _ in range(self.maxconn + 1):
+                conn = pool.getconn()
+                if is_usable(conn):
+                    return conn, True
+                pool.putconn(conn, close=True)
+            return connect(self.url), False
+        except psycopg2.pool.PoolError:
+            return connect(self.url), False
+        except psycopg2.OperationalError as e:
+            raise DatabaseError(e)
+
+    def putconn(self, conn, pooled, discard=False):
+        if not pooled:
+            conn.close()
+            return
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        conn.last_used = time.monotonic()
+        self._get_pool().putconn(conn, close=discard or bool(conn.closed))
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_replica_down_until = 0.0
+_state = threading.local()
+
+
+def get_pool(name):
+    url = os.environ.get('DATABASE_REPLICA_URL') if name == 'replica' else os.environ['DATABASE_URL']
+    if not url:
+        return
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = Pool(url, get_pool_size())
+        return _pools[name]
+
+
+def replica_available():
+    return time.monotonic() >= _replica_down_until
+
+
+def mark_replica_down():
+    global _replica_down_until
+    _replica_down_until = time.monotonic() + float(os.environ.get('DATABASE_REPLICA_RETRY_SECONDS', '30'))
+
+
+def reset_request_state():
+    """
+    Forget writes made by this thread (call at the start of each request)
+    """
+    _state.wrote = False
+
+
+@contextmanager
+def connection(readonly=False):
+    """
+    Check out a pooled connection
+
+    Reads go to DATABASE_REPLICA_URL when configured and healthy, unless
+    this thread has already written during the current request, in which
+    case they stay on the primary to read their own writes.
+    """
+    pool = None
+    if readonly and not getattr(_state, 'wrote', False) and replica_available():
+        pool = get_pool('replica')
+        if pool is not None:
+            try:
+                conn, pooled = pool.getconn()
+            except DatabaseError:
+                mark_replica_down()
+                pool = None
+    if pool is None:
+        pool = get_pool('primary')
+        conn, pooled = pool.getconn()
+    _state.replica = pool is _pools.get('replica')
+    if not readonly:
+        _state.wrote = True
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        pool.putconn(conn, pooled, discard=True)
+        if pool is _pools.get('replica'):
+            mark_replica_down()
+        raise DatabaseError(e)
+    except BaseException:
+        pool.putconn(conn, pooled)
+        raise
+    else:
+        pool.putconn(conn, pooled)
+
+
+def read_with_retry(func, *args, **kwargs):
+    """
+    Run a read, retrying it once (on the primary) if the replica failed
+    part way through
+    """
+    try:
+        return func(*args, **kwargs)
+    except DatabaseError:
+        if not getattr(_state, 'replica', False) or replica_available():
+            raise
+        return func(*args, **kwargs)
+
+
 def add_column(table, col, col_type):
     with closing(get_connection()) as conn:
         try:
             cur = conn.cursor()
-            cur.execute(f'ALTER TABLE {table} ADD {col} {col_type}')
+            cur.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {col} {col_type}')
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
@@ -0,0 +1,86 @@
+import psycopg2
+import psycopg2.extras
+
+from albumlistbot.models import DatabaseError, connection
+
+
+def create_autoscale_table():
+    sql = """
+        CREATE TABLE IF NOT EXISTS autoscale (
+        app varchar PRIMARY KEY,
+        team varchar NOT NULL,
+        formation jsonb,
+        form jsonb NOT NULL,
+        deadline timestamptz NOT NULL,
+        checked timestamptz DEFAULT now(),
+        attempts integer DEFAULT 0
+        );"""
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def add_watch(app, team, formation, form, timeout):
+    """
+    Record that app is being scaled up for processing, returning False if
+    another worker already is (the primary key makes the claim unique)
+    """
+    sql = """
+        INSERT INTO autoscale (app, team, formation, form, deadline)
+        VALUES (%s, %s, %s, %s, now() + %s * interval '1 second')
+        ON CONFLICT (app) DO NOTHING
+        RETURNING app;"""
+    params = (app, team, psycopg2.extras.Json(formation), psycopg2.extras.Json(form), timeout)
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            added = cur.fetchone() is not None
+            conn.commit()
+            return added
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def claim_due_watches(interval):
+    """
+    Take the watches not checked for interval seconds, leasing each to the
+    caller until then so workers don't check the same app at once
+    """
+    sql = """
+        UPDATE autoscale SET checked = now()
+        WHERE checked < now() - %s * interval '1 second'
+        RETURNING app, team, formation, form, deadline < now(), attempts;"""
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, (interval,))
+            rows = cur.fetchall()
+            conn.commit()
+            return rows
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def record_attempt(app):
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('UPDATE autoscale SET attempts = attempts + 1 WHERE app = %s;', (app,))
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def remove_watch(app):
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('DELETE FROM autoscale WHERE app = %s;', (app,))
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
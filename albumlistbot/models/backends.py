@@ -0,0 +1,519 @@
+import csv
+import os
+import re
+import sqlite3
+import struct
+import threading
+
+import psycopg2
+
+from albumlistbot.models import DatabaseError, connection, read_with_retry, statements
+
+
+COLUMNS = ('team', 'app', 'token', 'heroku', 'heroku_refresh', 'events')
+MAPPING_CHANNEL = 'mapping_changed'
+COPY_FORMATS = {
+    'csv': '(FORMAT csv, HEADER true)',
+    'binary': '(FORMAT binary)',
+}
+BINARY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+ENV_KEY_REGEX = re.compile(r'^([TE][A-Z0-9]+)_(APP|TOKEN|HEROKU|HEROKU_REFRESH|EVENTS)$')
+
+
+def check_columns(columns):
+    for col in columns:
+        if col not in COLUMNS:
+            raise DatabaseError(f'unknown mapping column: {col}')
+    return ', '.join(columns)
+
+
+def copy_options(fmt):
+    try:
+        return COPY_FORMATS[fmt]
+    except KeyError:
+        raise DatabaseError(f'unknown copy format: {fmt}')
+
+
+class Replay(object):
+    """
+    File-like wrapper giving back bytes already read from file
+    """
+    def __init__(self, head, file):
+        self.head = head
+        self.file = file
+
+    def read(self, size=-1):
+        if self.head:
+            data, self.head = self.head, b''
+            return data
+        return self.file.read(size)
+
+
+def copy_columns(file, fmt):
+    """
+    Work out which mapping columns a COPY stream holds (backups taken
+    before a column was added hold only the ones before it), returning
+    them with a file to COPY from
+    """
+    if fmt == 'csv':
+        header = file.readline()
+        columns = tuple(col.strip() for col in next(csv.reader([header.decode('utf-8')]), [])) or COLUMNS
+        check_columns(columns)
+        return columns, Replay(header, file)
+    head = file.read(len(BINARY_SIGNATURE) + 8)
+    if not head.startswith(BINARY_SIGNATURE):
+        raise DatabaseError('not a binary COPY file')
+    head += file.read(struct.unpack('!i', head[-4:])[0])
+    head += file.read(2)
+    count = struct.unpack('!h', head[-2:])[0]
+    if count == -1:
+        return COLUMNS, Replay(head, file)
+    if not 0 < count <= len(COLUMNS):
+        raise DatabaseError(f'unexpected column count: {count}')
+    return COLUMNS[:count], Replay(head, file)
+
+
+def project(row, columns):
+    return tuple(row[COLUMNS.index(col)] for col in columns)
+
+
+class MappingBackend(object):
+    """
+    Storage interface used by all mapping accessors
+
+    Rows are returned as tuples ordered as the requested columns, or
+    None when no row matches.
+    """
+    name = None
+
+    def create_table(self):
+        raise NotImplementedError
+
+    def get(self, team, columns):
+        raise NotImplementedError
+
+    def get_by_token(self, token, columns):
+        raise NotImplementedError
+
+    def get_many(self, teams, columns):
+        raise NotImplementedError
+
+    def all(self, columns):
+        raise NotImplementedError
+
+    def exists(self, team):
+        return self.get(team, ('team',)) is not None
+
+    def insert(self, team, **values):
+        raise NotImplementedError
+
+    def update(self, team, returning=None, **values):
+        raise NotImplementedError
+
+    def upsert(self, team, returning, **values):
+        raise NotImplementedError
+
+    def delete(self, team):
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+    def notify(self, team):
+        """
+        Tell other workers to drop their cached entries for team (nothing to
+        do where caches aren't shared between processes)
+        """
+
+    def export(self, file, fmt):
+        raise DatabaseError(f'export is not supported by the {self.name} backend')
+
+    def import_(self, file, fmt):
+        raise DatabaseError(f'import is not supported by the {self.name} backend')
+
+
+class PostgresBackend(MappingBackend):
+    name = 'postgres'
+
+    def execute(self, sql, params=(), fetch=None, commit=False, notify=None):
+        if not commit:
+            return read_with_retry(self._execute, sql, params, fetch, commit, notify)
+        return self._execute(sql, params, fetch, commit, notify)
+
+    def _execute(self, sql, params, fetch, commit, notify):
+        with connection(readonly=not commit) as conn:
+            try:
+                cur = conn.cursor()
+                cur.execute(sql, params)
+                result = getattr(cur, fetch)() if fetch else None
+                if notify is not None:
+                    cur.execute('SELECT pg_notify(%s, %s);', (MAPPING_CHANNEL, notify))
+                if commit:
+                    conn.commit()
+                return result
+            except (psycopg2.IntegrityError, psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+                raise DatabaseError(e)
+
+    def create_table(self):
+        sql = """
+            CREATE TABLE IF NOT EXISTS mapping (
+            team varchar UNIQUE,
+            app varchar DEFAULT '',
+            token varchar DEFAULT '',
+            heroku varchar DEFAULT '',
+            heroku_refresh varchar DEFAULT '',
+            events varchar DEFAULT ''
+            );"""
+        self.execute(sql, commit=True)
+
+    def execute_prepared(self, name, params, fetch):
+        return read_with_retry(self._execute_prepared, name, params, fetch)
+
+    def _execute_prepared(self, name, params, fetch):
+        with connection(readonly=True) as conn:
+            try:
+                return getattr(statements.execute(conn, name, params), fetch)()
+            except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+                raise DatabaseError(e)
+
+    def get(self, team, columns):
+        check_columns(columns)
+        row = self.execute_prepared('mapping_by_team', (team,), fetch='fetchone')
+        return project(row, columns) if row else None
+
+    def get_by_token(self, token, columns):
+        check_columns(columns)
+        row = self.execute_prepared('mapping_by_token', (token,), fetch='fetchone')
+        return project(row, columns) if row else None
+
+    def get_many(self, teams, columns):
+        check_columns(columns)
+        rows = self.execute_prepared('mapping_by_teams', (list(teams),), fetch='fetchall')
+        return [project(row, columns) for row in rows]
+
+    def all(self, columns):
+        sql = f'SELECT {check_columns(columns)} FROM mapping;'
+        return self.execute(sql, fetch='fetchall')
+
+    def insert(self, team, **values):
+        columns = ('team',) + tuple(values)
+        placeholders = ', '.join(['%s'] * len(columns))
+        sql = f'INSERT INTO mapping ({check_columns(columns)}) VALUES ({placeholders});'
+        try:
+            self.execute(sql, (team, *values.values()), commit=True, notify=team)
+        except DatabaseError as e:
+            if isinstance(e.args[0], psycopg2.IntegrityError):
+                raise DatabaseError(f'mapping already exists for {team}')
+            raise
+
+    def update(self, team, returning=None, **values):
+        check_columns(values)
+        assignments = ', '.join(f'{col} = %s' for col in values)
+        sql = f'UPDATE mapping SET {assignments} WHERE team = %s'
+        if returning:
+            sql += f' RETURNING {check_columns(returning)}'
+        return self.execute(sql + ';', (*values.values(), team), fetch='fetchone' if returning else None, commit=True, notify=team)
+
+    def upsert(self, team, returning, **values):
+        columns = ('team',) + tuple(values)
+        placeholders = ', '.join(['%s'] * len(columns))
+        assignments = ', '.join(f'{col} = EXCLUDED.{col}' for col in values)
+        sql = f"""
+            INSERT INTO mapping ({check_columns(columns)}) VALUES ({placeholders})
+            ON CONFLICT (team) DO UPDATE SET {assignments}
+            RETURNING {check_columns(returning)};"""
+        return self.execute(sql, (team, *values.values()), fetch='fetchone', commit=True, notify=team)
+
+    def delete(self, team):
+        self.execute('DELETE FROM mapping WHERE team = %s;', (team,), commit=True, notify=team)
+
+    def reset(self):
+        self.execute('DELETE FROM mapping;', commit=True, notify='*')
+
+    def notify(self, team):
+        self.execute('SELECT pg_notify(%s, %s);', (MAPPING_CHANNEL, team), commit=True)
+
+    def export(self, file, fmt):
+        """
+        Stream the table to file with COPY ... TO STDOUT (exempt from the
+        statement timeout)
+        """
+        sql = f'COPY mapping ({check_columns(COLUMNS)}) TO STDOUT WITH {copy_options(fmt)};'
+        with connection(readonly=True) as conn:
+            try:
+                cur = conn.cursor()
+                cur.execute('SET LOCAL statement_timeout = 0;')
+                cur.copy_expert(sql, file)
+            except (psycopg2.ProgrammingError, psycopg2.InternalError, psycopg2.DataError) as e:
+                raise DatabaseError(e)
+
+    def import_(self, file, fmt):
+        """
+        Stream file into a staging table with COPY ... FROM STDIN and merge
+        it into mapping, returning the number of rows written (columns
+        missing from older backups take their defaults; exempt from the
+        statement timeout)
+        """
+        copy_options(fmt)
+        copied, file = copy_columns(file, fmt)
+        columns = check_columns(COLUMNS)
+        assignments = ', '.join(f'{col} = EXCLUDED.{col}' for col in COLUMNS if col != 'team')
+        merge = f"""
+            INSERT INTO mapping ({columns})
+            SELECT DISTINCT ON (team) {columns} FROM mapping_staging
+            WHERE team IS NOT NULL
+            ORDER BY team
+            ON CONFLICT (team) DO UPDATE SET {assignments};"""
+        with connection() as conn:
+            try:
+                cur = conn.cursor()
+                cur.execute('SET LOCAL statement_timeout = 0;')
+                cur.execute('CREATE TEMP TABLE mapping_staging (LIKE mapping INCLUDING DEFAULTS) ON COMMIT DROP;')
+                cur.copy_expert(f'COPY mapping_staging ({check_columns(copied)}) FROM STDIN WITH {copy_options(fmt)};', file)
+                cur.execute(merge)
+                count = cur.rowcount
+                cur.execute('SELECT pg_notify(%s, %s);', (MAPPING_CHANNEL, '*'))
+                conn.commit()
+                return count
+            except (psycopg2.ProgrammingError, psycopg2.InternalError, psycopg2.DataError) as e:
+                raise DatabaseError(e)
+
+
+class EnvBackend(MappingBackend):
+    """
+    Read-mostly store built once from {TEAM}_{COLUMN} environment variables
+
+    Writes only update this process's index.
+    """
+    name = 'env'
+
+    def __init__(self, environ=None):
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._tokens = {}
+        for key, value in (os.environ if environ is None else environ).items():
+            match = ENV_KEY_REGEX.match(key)
+            if match:
+                team, col = match.groups()
+                self._rows.setdefault(team, dict(team=team))[col.lower()] = value
+        for team, row in self._rows.items():
+            if row.get('token'):
+                self._tokens[row['token']] = team
+
+    def _row(self, row, columns):
+        check_columns(columns)
+        return tuple(row.get(col, '') for col in columns)
+
+    def create_table(self):
+        pass
+
+    def get(self, team, columns):
+        row = self._rows.get(team.upper())
+        return self._row(row, columns) if row is not None else None
+
+    def get_by_token(self, token, columns):
+        team = self._tokens.get(token)
+        return self.get(team, columns) if team is not None else None
+
+    def get_many(self, teams, columns):
+        return [self._row(self._rows[team.upper()], columns) for team in teams if team.upper() in self._rows]
+
+    def all(self, columns):
+        return [self._row(row, columns) for row in self._rows.values()]
+
+    def insert(self, team, **values):
+        check_columns(values)
+        with self._lock:
+            if team.upper() in self._rows:
+                raise DatabaseError(f'mapping already exists for {team}')
+            self._rows[team.upper()] = dict(team=team.upper())
+        self.update(team, **values)
+
+    def update(self, team, returning=None, **values):
+        check_columns(values)
+        with self._lock:
+            row = self._rows.get(team.upper())
+            if row is None:
+                return
+            if 'token' in values:
+                self._tokens.pop(row.get('token'), None)
+                self._tokens[values['token']] = row['team']
+            row.update(values)
+            if returning:
+                return self._row(row, returning)
+
+    def upsert(self, team, returning, **values):
+        with self._lock:
+            self._rows.setdefault(team.upper(), dict(team=team.upper()))
+        return self.update(team, returning=returning, **values)
+
+    def delete(self, team):
+        with self._lock:
+            row = self._rows.pop(team.upper(), None)
+            if row is not None:
+                self._tokens.pop(row.get('token'), None)
+
+    def reset(self):
+        with self._lock:
+            self._rows.clear()
+            self._tokens.clear()
+
+
+class SQLiteBackend(MappingBackend):
+    """
+    Embedded store for single-dyno deployments and local testing
+    """
+    name = 'sqlite'
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('SQLITE_DATABASE_PATH', 'albumlistbot.sqlite3')
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._pid = os.getpid()
+            self._create_table(self._conn)
+        return self._conn
+
+    def _create_table(self, conn):
+        sql = """
+            CREATE TABLE IF NOT EXISTS mapping (
+            team varchar UNIQUE,
+            app varchar DEFAULT '',
+            token varchar DEFAULT '',
+            heroku varchar DEFAULT '',
+            heroku_refresh varchar DEFAULT '',
+            events varchar DEFAULT ''
+            );"""
+        conn.execute(sql)
+        try:
+            conn.execute("ALTER TABLE mapping ADD events varchar DEFAULT '';")
+        except sqlite3.OperationalError:
+            pass
+        conn.commit()
+
+    def execute(self, sql, params=(), fetch=None, commit=False):
+        with self._lock:
+            conn = self.connection()
+            try:
+                cur = conn.execute(sql, params)
+                result = getattr(cur, fetch)() if fetch else None
+                if commit:
+                    conn.commit()
+                return result
+            except sqlite3.Error as e:
+                conn.rollback()
+                raise DatabaseError(e)
+
+    def execute_many(self, statements, fetch=None):
+        """
+        Run statements in one transaction, fetching from the last
+        """
+        with self._lock:
+            conn = self.connection()
+            try:
+                for sql, params in statements:
+                    cur = conn.execute(sql, params)
+                result = getattr(cur, fetch)() if fetch else None
+                conn.commit()
+                return result
+            except sqlite3.Error as e:
+                conn.rollback()
+                raise DatabaseError(e)
+
+    def create_table(self):
+        with self._lock:
+            self._create_table(self.connection())
+
+    def get(self, team, columns):
+        sql = f'SELECT {check_columns(columns)} FROM mapping WHERE team = ?;'
+        return self.execute(sql, (team,), fetch='fetchone')
+
+    def get_by_token(self, token, columns):
+        sql = f'SELECT {check_columns(columns)} FROM mapping WHERE token = ?;'
+        return self.execute(sql, (token,), fetch='fetchone')
+
+    def get_many(self, teams, columns):
+        teams = list(teams)
+        if not teams:
+            return []
+        placeholders = ', '.join(['?'] * len(teams))
+        sql = f'SELECT {check_columns(columns)} FROM mapping WHERE team IN ({placeholders});'
+        return self.execute(sql, teams, fetch='fetchall')
+
+    def all(self, columns):
+        sql = f'SELECT {check_columns(columns)} FROM mapping;'
+        return self.execute(sql, fetch='fetchall')
+
+    def insert(self, team, **values):
+        columns = ('team',) + tuple(values)
+        placeholders = ', '.join(['?'] * len(columns))
+        sql = f'INSERT INTO mapping ({check_columns(columns)}) VALUES ({placeholders});'
+        try:
+            self.execute(sql, (team, *values.values()), commit=True)
+        except DatabaseError as e:
+            if isinstance(e.args[0], sqlite3.IntegrityError):
+                raise DatabaseError(f'mapping already exists for {team}')
+            raise
+
+    def update(self, team, returning=None, **values):
+        check_columns(values)
+        assignments = ', '.join(f'{col} = ?' for col in values)
+        sql = f'UPDATE mapping SET {assignments} WHERE team = ?;'
+        if not returning:
+            return self.execute(sql, (*values.values(), team), commit=True)
+        select = f'SELECT {check_columns(returning)} FROM mapping WHERE team = ?;'
+        return self.execute_many([(sql, (*values.values(), team)), (select, (team,))], fetch='fetchone')
+
+    def upsert(self, team, returning, **values):
+        columns = ('team',) + tuple(values)
+        placeholders = ', '.join(['?'] * len(columns))
+        assignments = ', '.join(f'{col} = excluded.{col}' for col in values)
+        sql = f"""
+            INSERT INTO mapping ({check_columns(columns)}) VALUES ({placeholders})
+            ON CONFLICT (team) DO UPDATE SET {assignments};"""
+        select = f'SELECT {check_columns(returning)} FROM mapping WHERE team = ?;'
+        return self.execute_many([(sql, (team, *values.values())), (select, (team,))], fetch='fetchone')
+
+    def delete(self, team):
+        self.execute('DELETE FROM mapping WHERE team = ?;', (team,), commit=True)
+
+    def reset(self):
+        self.execute('DELETE FROM mapping;', commit=True)
+
+
+BACKENDS = {
+    'postgres': PostgresBackend,
+    'env': EnvBackend,
+    'sqlite': SQLiteBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def default_backend_name():
+    if bool(int(os.environ.get('DISABLE_DATABASE', '0'))):
+        return 'env'
+    return 'postgres'
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = os.environ.get('MAPPING_BACKEND') or default_backend_name()
+                try:
+                    _backend = BACKENDS[name]()
+                except KeyError:
+                    raise DatabaseError(f'unknown mapping backend: {name}')
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
@@ -0,0 +1,82 @@
+import psycopg2
+
+from albumlistbot.models import DatabaseError, connection
+
+
+def create_interactions_table():
+    sql = """
+        CREATE TABLE IF NOT EXISTS interactions (
+        team varchar NOT NULL,
+        callback varchar NOT NULL,
+        interaction varchar NOT NULL,
+        status varchar,
+        created timestamptz DEFAULT now(),
+        PRIMARY KEY (team, callback, interaction)
+        );"""
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def claim_interaction(team, callback, interaction, ttl):
+    """
+    Claim an interaction for the caller to run, returning (True, None), or
+    (False, status) when it has already run (status is None while it's
+    still running, here or for another of the team's interactions with
+    the same callback)
+
+    An advisory lock serialises claims per team and callback across
+    workers; rows older than ttl seconds are forgotten.
+    """
+    sql = """
+        INSERT INTO interactions (team, callback, interaction) VALUES (%s, %s, %s)
+        ON CONFLICT (team, callback, interaction) DO NOTHING
+        RETURNING interaction;"""
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT pg_try_advisory_xact_lock(hashtext(%s));', (f'{team}:{callback}',))
+            if not cur.fetchone()[0]:
+                return False, None
+            cur.execute(
+                "DELETE FROM interactions WHERE team = %s AND callback = %s AND created < now() - %s * interval '1 second';",
+                (team, callback, ttl))
+            cur.execute(
+                'SELECT interaction, status FROM interactions WHERE team = %s AND callback = %s AND (interaction = %s OR status IS NULL);',
+                (team, callback, interaction))
+            rows = dict(cur.fetchall())
+            if interaction in rows:
+                return False, rows[interaction]
+            if rows:
+                return False, None
+            cur.execute(sql, (team, callback, interaction))
+            claimed = cur.fetchone() is not None
+            conn.commit()
+            return claimed, None
+        except (psycopg2.ProgrammingError, psycopg2.InternalError, psycopg2.IntegrityError) as e:
+            raise DatabaseError(e)
+
+
+def finish_interaction(team, callback, interaction, status):
+    """
+    Record the status duplicates get, or forget the interaction (status
+    None) so that it can be tried again
+    """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            if status is None:
+                cur.execute(
+                    'DELETE FROM interactions WHERE team = %s AND callback = %s AND interaction = %s;',
+                    (team, callback, interaction))
+            else:
+                cur.execute(
+                    'UPDATE interactions SET status = %s WHERE team = %s AND callback = %s AND interaction = %s;',
+                    (status, team, callback, interaction))
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
@@ -0,0 +1,63 @@
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from albumlistbot import cache
+from albumlistbot.models import DatabaseError, get_connection
+from albumlistbot.models.backends import MAPPING_CHANNEL
+
+
+_listener = None
+
+
+def handle_notification(notification):
+    if notification.payload == '*':
+        cache.clear_all()
+    else:
+        cache.evict_team(notification.payload)
+
+
+def listen(logger, poll_timeout=5.0, max_backoff=60.0):
+    backoff = 1.0
+    while True:
+        try:
+            conn = get_connection()
+        except DatabaseError as e:
+            logger.error(f'[listener]: failed to connect: {e}')
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+            continue
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute(f'LISTEN {MAPPING_CHANNEL};')
+            # anything cached while disconnected may have missed a notification
+            cache.clear_all()
+            backoff = 1.0
+            logger.info(f'[listener]: listening on {MAPPING_CHANNEL}')
+            while True:
+                if select.select([conn], [], [], poll_timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    handle_notification(conn.notifies.pop(0))
+        except (psycopg2.Error, OSError) as e:
+            logger.error(f'[listener]: connection lost: {e}')
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+        finally:
+            conn.close()
+
+
+def start_listener(logger):
+    """
+    Start a daemon thread evicting cached team entries on NOTIFY
+    """
+    global _listener
+    if _listener is not None and _listener.is_alive():
+        return _listener
+    _listener = threading.Thread(target=listen, args=(logger,), name='mapping-listener', daemon=True)
+    _listener.start()
+    return _listener
@@ -1,373 +1,173 @@
-from contextlib import closing
-import json
-import os
-import psycopg2
+import functools
 
-from albumlistbot.models import DatabaseError, get_connection
+from albumlistbot import cache, metrics
+from albumlistbot.models import DatabaseError, add_column, snapshot
+from albumlistbot.models.backends import get_backend
 
 
-DISABLE_DATABASE = bool(int(os.environ.get("DISABLE_DATABASE", "0")))
+def _first(row):
+    return row[0] if row else None
 
 
-def get_from_env(team, variable):
-    return os.environ.get(f"{team.upper()}_{variable.upper()}", "")
+def evicts_team(func):
+    """
+    Decorator for writers: drop this worker's cached entries for the team
+    (other workers are told via NOTIFY on the postgres backend)
+    """
+    @functools.wraps(func)
+    def wraps(team, *args, **kwargs):
+        try:
+            return func(team, *args, **kwargs)
+        finally:
+            cache.evict_team(team)
+    return wraps
+
+
+def evict_team_everywhere(team):
+    """
+    Drop cached entries for the team in every worker, for changes made
+    outside the mapping table (such as an albumlist's config)
+    """
+    cache.evict_team(team)
+    get_backend().notify(team)
+
+
+def read_with_fallback(method, snapshot_method, *args):
+    """
+    Read from the backend, answering from the on-disk snapshot instead
+    when the database is unavailable
+    """
+    try:
+        return getattr(get_backend(), method)(*args)
+    except DatabaseError:
+        if not snapshot.available():
+            raise
+        metrics.incr('mapping.snapshot_reads')
+        return snapshot_method(*args)
+
+
+def _get(team, columns):
+    return read_with_fallback('get', snapshot.get, team, columns)
+
+
+def _get_by_token(token, columns):
+    return read_with_fallback('get_by_token', snapshot.get_by_token, token, columns)
 
 
 def create_mapping_table():
-    if DISABLE_DATABASE:
-        return
-    sql = """
-        CREATE TABLE mapping (
-        team varchar UNIQUE,
-        app varchar DEFAULT '',
-        token varchar DEFAULT '',
-        heroku varchar DEFAULT '',
-        heroku_refresh varchar DEFAULT '',
-        );"""
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql)
-            conn.commit()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    get_backend().create_table()
 
 
 def get_mappings():
-    if DISABLE_DATABASE:
-        return
-    sql = """
-        SELECT team, app FROM mapping;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql)
-            return cur.fetchall()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return get_backend().all(('team', 'app'))
 
 
 def team_exists(team):
-    if DISABLE_DATABASE:
-        return any(key.startswith(team) for key in os.environ.keys())
-    sql = """
-        SELECT *
-        FROM mapping
-        WHERE team = %s;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (team,))
-            cur.fetchone()[0]
-            return True
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
-        except (IndexError, TypeError):
-            return False
+    return get_backend().exists(team)
 
 
 def get_app_url_for_team(team):
-    if DISABLE_DATABASE:
-        return get_from_env(team, "app")
-    sql = """
-        SELECT app
-        FROM mapping
-        WHERE team = %s;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (team,))
-            return cur.fetchone()[0]
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
-        except (IndexError, TypeError):
-            return
+    return _first(_get(team, ('app',)))
+
+
+def get_app_urls_for_teams(teams):
+    return read_with_fallback('get_many', snapshot.get_many, teams, ('team', 'app'))
 
 
 def get_slack_token_for_team(team):
-    if DISABLE_DATABASE:
-        return get_from_env(team, "token")
-    sql = """
-        SELECT token
-        FROM mapping
-        WHERE team = %s;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (team,))
-            return cur.fetchone()[0]
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
-        except (IndexError, TypeError):
-            return
+    return _first(_get(team, ('token',)))
 
 
 def get_team_app_by_slack(token):
-    if DISABLE_DATABASE:
-        inv_env = {os.environ[k]: k for k in os.environ}
-        team = inv_env[token].split("_")[0]
-        return (
-            team,
-            get_from_env(team, "app"),
-        )
-    sql = """
-        SELECT team, app
-        FROM mapping
-        WHERE token = %s;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (token,))
-            return cur.fetchone()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return _get_by_token(token, ('team', 'app'))
 
 
 def get_team_app_heroku_by_slack(token):
-    if DISABLE_DATABASE:
-        return
-    sql = """
-        SELECT team, app, heroku
-        FROM mapping
-        WHERE token = %s;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (token,))
-            return cur.fetchone()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return _get_by_token(token, ('team', 'app', 'heroku'))
 
 
 def get_heroku_token_for_team(team):
-    if DISABLE_DATABASE:
-        return get_from_env(team, "heroku")
-    sql = """
-        SELECT heroku
-        FROM mapping
-        WHERE team = %s;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (team,))
-            return cur.fetchone()[0]
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
-        except (IndexError, TypeError):
-            return
+    return _first(_get(team, ('heroku',)))
 
 
 def get_heroku_refresh_token_for_team(team):
-    if DISABLE_DATABASE:
-        return get_from_env(team, "heroku_refresh")
-    sql = """
-        SELECT heroku_refresh
-        FROM mapping
-        WHERE team = %s;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (team,))
-            return cur.fetchone()[0]
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
-        except (IndexError, TypeError):
-            return
+    return _first(_get(team, ('heroku_refresh',)))
 
 
 def get_app_and_slack_token_for_team(team):
-    if DISABLE_DATABASE:
-        return (
-            get_from_env(team, "app"),
-            get_from_env(team, "token"),
-        )
-    sql = """
-        SELECT app, token
-        FROM mapping
-        WHERE team = %s;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (team,))
-            return cur.fetchone()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return _get(team, ('app', 'token'))
+
+
+def get_app_and_event_filter_for_team(team):
+    return _get(team, ('app', 'events'))
 
 
 def get_tokens_for_team(team):
-    if DISABLE_DATABASE:
-        return (
-            get_from_env(team, "token"),
-            get_from_env(team, "heroku"),
-        )
-    sql = """
-        SELECT token, heroku
-        FROM mapping
-        WHERE team = %s;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (team,))
-            return cur.fetchone()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return _get(team, ('token', 'heroku'))
 
 
 def get_app_and_heroku_token_for_team(team):
-    if DISABLE_DATABASE:
-        return (
-            get_from_env(team, "app"),
-            get_from_env(team, "heroku"),
-        )
-    sql = """
-        SELECT app, heroku
-        FROM mapping
-        WHERE team = %s;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (team,))
-            return cur.fetchone()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return _get(team, ('app', 'heroku'))
 
 
 def get_app_slack_heroku_for_team(team):
-    if DISABLE_DATABASE:
-        return (
-            get_from_env(team, "app"),
-            get_from_env(team, "token"),
-            get_from_env(team, "heroku"),
-        )
-    sql = """
-        SELECT app, token, heroku
-        FROM mapping
-        WHERE team = %s;
-    """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (team,))
-            return cur.fetchone()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return _get(team, ('app', 'token', 'heroku'))
 
 
+@evicts_team
 def add_team_with_token(team, token):
-    if DISABLE_DATABASE:
-        return
-    sql = """
-        INSERT INTO mapping (team, token) VALUES (%s, %s);"""
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (team, token))
-            conn.commit()
-        except psycopg2.IntegrityError:
-            raise DatabaseError(f'mapping already exists for {team}')
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    get_backend().insert(team, token=token)
 
 
+@evicts_team
 def set_mapping_for_team(team, app_url):
-    if DISABLE_DATABASE:
-        return
-    sql = """
-        UPDATE mapping
-        SET app = %s
-        WHERE team = %s;
-        """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (app_url, team))
-            conn.commit()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return get_backend().update(team, returning=('app', 'token', 'heroku'), app=app_url)
 
 
+@evicts_team
 def set_slack_token_for_team(team, token):
-    if DISABLE_DATABASE:
-        return
-    sql = """
-        UPDATE mapping
-        SET token = %s
-        WHERE team = %s;
-        """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (token, team))
-            conn.commit()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return get_backend().update(team, returning=('app', 'token', 'heroku'), token=token)
 
 
+@evicts_team
 def set_heroku_and_refresh_token_for_team(team, token, refresh):
-    if DISABLE_DATABASE:
-        return
-    sql = """
-        UPDATE mapping
-        SET heroku = %s,
-            heroku_refresh = %s
-        WHERE team = %s;
-        """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (token, refresh, team))
-            conn.commit()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return get_backend().update(team, returning=('app', 'token', 'heroku'), heroku=token, heroku_refresh=refresh)
 
 
+@evicts_team
 def set_heroku_token_for_team(team, token):
-    if DISABLE_DATABASE:
-        return
-    sql = """
-        UPDATE mapping
-        SET heroku = %s
-        WHERE team = %s;
-        """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (token, team))
-            conn.commit()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return get_backend().update(team, returning=('app', 'token', 'heroku'), heroku=token)
+
+
+@evicts_team
+def upsert_slack_token_for_team(team, token):
+    return get_backend().upsert(team, returning=('app', 'heroku'), token=token)
+
+
+def export_mapping(file, fmt='csv'):
+    get_backend().export(file, fmt)
+
+
+def import_mapping(file, fmt='csv'):
+    count = get_backend().import_(file, fmt)
+    cache.clear_all()
+    return count
+
+
+@evicts_team
+def set_event_filter_for_team(team, events):
+    return get_backend().update(team, returning=('events',), events=events)
+
+
+def add_events_column():
+    add_column('mapping', 'events', "varchar DEFAULT ''")
 
 
 def _reset_mapping():
-    if DISABLE_DATABASE:
-        return
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute('DELETE FROM mapping')
-            conn.commit()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    get_backend().reset()
+    cache.clear_all()
 
 
+@evicts_team
 def delete_from_mapping(team):
-    if DISABLE_DATABASE:
-        return
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute('DELETE FROM mapping where team = %s;', (team,))
-            conn.commit()
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    get_backend().delete(team)
@@ -0,0 +1,121 @@
+import psycopg2
+import psycopg2.extras
+
+from albumlistbot.models import DatabaseError, connection
+
+
+def create_outbox_table():
+    sql = """
+        CREATE TABLE IF NOT EXISTS outbox (
+        id bigserial PRIMARY KEY,
+        app varchar NOT NULL,
+        team varchar,
+        payload jsonb NOT NULL,
+        created timestamptz DEFAULT now(),
+        claimed timestamptz
+        );
+        CREATE INDEX IF NOT EXISTS outbox_app_id ON outbox (app, id);"""
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def add_events(rows):
+    """
+    Add (app, team, payload) rows in one multi-row insert
+    """
+    sql = 'INSERT INTO outbox (app, team, payload) VALUES %s;'
+    rows = [(app, team, psycopg2.extras.Json(payload)) for app, team, payload in rows]
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            psycopg2.extras.execute_values(cur, sql, rows, page_size=1000)
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError, psycopg2.IntegrityError) as e:
+            raise DatabaseError(e)
+
+
+def claim_events(app, limit, lease):
+    """
+    Claim app's oldest events for lease seconds and return them as (id,
+    payload) rows, oldest first
+
+    Nothing is claimed (None is returned) while another worker holds a
+    live claim on the app, so its events are sent by one worker, in order.
+    The claim is committed before returning, leaving no transaction open
+    while the events are sent.
+    """
+    sql = """
+        UPDATE outbox SET claimed = now()
+        WHERE id IN (
+            SELECT id FROM outbox WHERE app = %s ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, payload;"""
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT pg_try_advisory_xact_lock(hashtext(%s));', (app,))
+            if not cur.fetchone()[0]:
+                return None
+            cur.execute(
+                "SELECT 1 FROM outbox WHERE app = %s AND claimed > now() - %s * interval '1 second' LIMIT 1;",
+                (app, lease))
+            if cur.fetchone() is not None:
+                return None
+            cur.execute(sql, (app, limit))
+            rows = sorted(cur.fetchall())
+            conn.commit()
+            return rows
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def finish_events(delivered, undelivered):
+    """
+    Delete delivered event ids and release the claim on undelivered ones
+    """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            if delivered:
+                cur.execute('DELETE FROM outbox WHERE id = ANY(%s);', (delivered,))
+            if undelivered:
+                cur.execute('UPDATE outbox SET claimed = NULL WHERE id = ANY(%s);', (undelivered,))
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def maintain(max_age_hours, max_per_app):
+    """
+    Drop events older than max_age_hours and all but the newest max_per_app
+    per app, then count the events left per app
+
+    Returns (pruned, depths), or None when another worker is already doing
+    this (an advisory lock keeps it to one worker at a time).
+    """
+    sql = """
+        DELETE FROM outbox WHERE created < now() - %s * interval '1 hour'
+        OR id IN (
+            SELECT id FROM (
+                SELECT id, row_number() OVER (PARTITION BY app ORDER BY id DESC) AS n FROM outbox
+            ) ranked WHERE n > %s
+        );"""
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('outbox'));")
+            if not cur.fetchone()[0]:
+                return None
+            cur.execute(sql, (max_age_hours, max_per_app))
+            pruned = cur.rowcount
+            cur.execute('SELECT app, COUNT(*) FROM outbox GROUP BY app;')
+            depths = dict(cur.fetchall())
+            conn.commit()
+            return pruned, depths
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
@@ -0,0 +1,196 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from albumlistbot.models import DatabaseError
+from albumlistbot.models.backends import COLUMNS, check_columns, get_backend
+
+
+MAGIC = b'ALB1'
+HEADER = struct.Struct('<4sIII')
+SLOT = struct.Struct('<II')
+LENGTH = struct.Struct('<I')
+
+_reader = None
+_reader_lock = threading.Lock()
+_refresher = None
+
+
+def get_path():
+    return os.environ.get('MAPPING_SNAPSHOT_PATH', '/tmp/albumlistbot-mapping.snapshot')
+
+
+def key_hash(key):
+    return zlib.crc32(key.encode('utf-8'))
+
+
+def encode_row(row):
+    fields = []
+    for value in row:
+        data = (value or '').encode('utf-8')
+        fields.append(LENGTH.pack(len(data)) + data)
+    return b''.join(fields)
+
+
+def build_index(keys, offsets, slots):
+    table = [(0, 0)] * slots
+    for key, offset in zip(keys, offsets):
+        if not key:
+            continue
+        h = key_hash(key)
+        i = h % slots
+        while table[i][1]:
+            i = (i + 1) % slots
+        table[i] = (h, offset)
+    return b''.join(SLOT.pack(*slot) for slot in table)
+
+
+def write_snapshot(path, rows):
+    """
+    Write rows (full mapping rows in COLUMNS order) to path, replacing any
+    previous snapshot atomically
+
+    The file is a header, two open-addressed hash indexes (by team and by
+    slack token) of (crc32, offset) slots, then the rows as length-prefixed
+    UTF-8 fields. Workers mmap it, so lookups are O(1) and share the page
+    cache rather than each holding the mapping in its heap.
+    """
+    slots = max(len(rows) * 2, 1)
+    start = HEADER.size + 2 * slots * SLOT.size
+    records, offsets = [], []
+    offset = start
+    for row in rows:
+        record = encode_row(row)
+        offsets.append(offset)
+        records.append(record)
+        offset += len(record)
+    team_index = build_index([row[0] for row in rows], offsets, slots)
+    token_index = build_index([row[COLUMNS.index('token')] for row in rows], offsets, slots)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(rows), slots, int(time.time())))
+        f.write(team_index)
+        f.write(token_index)
+        f.writelines(records)
+    os.replace(tmp_path, path)
+
+
+class Reader(object):
+    """
+    Read-only view of one snapshot file
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.slots, self.created = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a mapping snapshot')
+
+    def read_row(self, offset):
+        row = []
+        for _ in COLUMNS:
+            length, = LENGTH.unpack_from(self.map, offset)
+            offset += LENGTH.size
+            row.append(self.map[offset:offset + length].decode('utf-8') or None)
+            offset += length
+        return tuple(row)
+
+    def lookup(self, key, index, column):
+        if not self.count:
+            return None
+        h = key_hash(key)
+        base = HEADER.size + index * self.slots * SLOT.size
+        i = h % self.slots
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self.map, base + i * SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == h:
+                row = self.read_row(offset)
+                if row[column] == key:
+                    return row
+            i = (i + 1) % self.slots
+
+
+def get_reader():
+    """
+    This worker's reader, reopened when the file has been replaced
+    """
+    global _reader
+    with _reader_lock:
+        try:
+            stat = os.stat(get_path())
+        except OSError:
+            return None
+        if _reader is None or _reader.stat.st_ino != stat.st_ino or _reader.stat.st_mtime != stat.st_mtime:
+            try:
+                _reader = Reader(get_path())
+            except (OSError, ValueError):
+                return None
+        return _reader
+
+
+def available():
+    return get_reader() is not None
+
+
+def _project(row, columns):
+    check_columns(columns)
+    return tuple(row[COLUMNS.index(column)] for column in columns) if row else None
+
+
+def get(team, columns):
+    reader = get_reader()
+    return _project(reader.lookup(team, 0, 0), columns) if reader else None
+
+
+def get_by_token(token, columns):
+    reader = get_reader()
+    return _project(reader.lookup(token, 1, COLUMNS.index('token')), columns) if reader else None
+
+
+def get_many(teams, columns):
+    rows = (get(team, columns) for team in teams)
+    return [row for row in rows if row is not None]
+
+
+def refresh(logger):
+    path = get_path()
+    rows = get_backend().all(COLUMNS)
+    write_snapshot(path, rows)
+    logger.info(f'[snapshot]: wrote {len(rows)} mappings to {path}')
+
+
+def run(logger, interval):
+    path = get_path()
+    while True:
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except OSError:
+            age = interval
+        if age >= interval:
+            try:
+                refresh(logger)
+            except DatabaseError as e:
+                logger.error(f'[snapshot]: refresh failed: {e}')
+            except Exception:
+                logger.exception('[snapshot]: refresh failed')
+        time.sleep(interval)
+
+
+def start_refresher(logger, interval):
+    """
+    Start a daemon thread rewriting the snapshot every interval seconds
+    (skipped when another worker on this dyno has just done so)
+    """
+    global _refresher
+    if _refresher is not None and _refresher.is_alive():
+        return _refresher
+    _refresher = threading.Thread(target=run, args=(logger, interval), name='mapping-snapshot', daemon=True)
+    _refresher.start()
+    return _refresher
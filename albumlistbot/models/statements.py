@@ -0,0 +1,46 @@
+import os
+
+import psycopg2
+
+
+# full rows are selected in backends.COLUMNS order
+STATEMENTS = {
+    'mapping_by_team': 'SELECT team, app, token, heroku, heroku_refresh, events FROM mapping WHERE team = $1',
+    'mapping_by_token': 'SELECT team, app, token, heroku, heroku_refresh, events FROM mapping WHERE token = $1',
+    'mapping_by_teams': 'SELECT team, app, token, heroku, heroku_refresh, events FROM mapping WHERE team = ANY($1)',
+}
+INVALID_SQL_STATEMENT_NAME = '26000'
+
+
+def enabled():
+    return bool(int(os.environ.get('DATABASE_PREPARED_STATEMENTS', '1')))
+
+
+def prepare(cur, name):
+    cur.execute(f'PREPARE {name} AS {STATEMENTS[name]};')
+    cur.connection.prepared.add(name)
+
+
+def execute(conn, name, params):
+    """
+    EXECUTE a registered statement, preparing it on first use per connection
+
+    Statements lost on the server (e.g. after DISCARD ALL) are prepared again.
+    """
+    cur = conn.cursor()
+    if not enabled():
+        cur.execute(STATEMENTS[name].replace('$1', '%s') + ';', params)
+        return cur
+    if name not in conn.prepared:
+        prepare(cur, name)
+    placeholders = ', '.join(['%s'] * len(params))
+    try:
+        cur.execute(f'EXECUTE {name} ({placeholders});', params)
+    except psycopg2.Error as e:
+        if e.pgcode != INVALID_SQL_STATEMENT_NAME:
+            raise
+        conn.rollback()
+        conn.prepared.clear()
+        prepare(cur, name)
+        cur.execute(f'EXECUTE {name} ({placeholders});', params)
+    return cur
@@ -0,0 +1,109 @@
+import psycopg2
+import psycopg2.extras
+
+from albumlistbot.models import DatabaseError, connection, read_with_retry
+
+
+def create_usage_table():
+    sql = """
+        CREATE TABLE IF NOT EXISTS usage (
+        team varchar,
+        kind varchar,
+        name varchar,
+        day date,
+        count bigint DEFAULT 0,
+        PRIMARY KEY (team, kind, name, day)
+        );"""
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def add_usage(rows):
+    """
+    Add (team, kind, name, day, count) rows in one multi-row upsert
+    """
+    sql = """
+        INSERT INTO usage (team, kind, name, day, count) VALUES %s
+        ON CONFLICT (team, kind, name, day) DO UPDATE
+        SET count = usage.count + EXCLUDED.count;"""
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            psycopg2.extras.execute_values(cur, sql, rows, page_size=1000)
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError, psycopg2.IntegrityError) as e:
+            raise DatabaseError(e)
+
+
+def prune_usage(days):
+    """
+    Drop counters older than days, returning how many rows went, or None
+    when another worker is already pruning (an advisory lock keeps it to
+    one worker at a time)
+    """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('usage'));")
+            if not cur.fetchone()[0]:
+                return None
+            cur.execute('DELETE FROM usage WHERE day < CURRENT_DATE - %s;', (days,))
+            conn.commit()
+            return cur.rowcount
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_usage(days, team=None):
+    return read_with_retry(_get_usage, days, team)
+
+
+def _get_usage(days, team):
+    sql = """
+        SELECT team, kind, name, SUM(count) AS total
+        FROM usage
+        WHERE day > CURRENT_DATE - %s
+        AND (%s IS NULL OR team = %s)
+        GROUP BY team, kind, name
+        ORDER BY total DESC;
+    """
+    with connection(readonly=True) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, (days, team, team))
+            return cur.fetchall()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_hour_scores(hour, history_days, idle_days, decay):
+    """
+    Score each team recently active at hour (of the week, as recorded
+    under the 'hour' kind) by its counts, decayed by decay per day of age
+    """
+    return read_with_retry(_get_hour_scores, hour, history_days, idle_days, decay)
+
+
+def _get_hour_scores(hour, history_days, idle_days, decay):
+    sql = """
+        SELECT team, SUM(count * power(%s, CURRENT_DATE - day)) AS score
+        FROM usage
+        WHERE kind = 'hour' AND name = %s
+        AND day > CURRENT_DATE - %s
+        AND team IN (
+            SELECT team FROM usage
+            WHERE kind = 'hour' AND day > CURRENT_DATE - %s)
+        GROUP BY team;
+    """
+    with connection(readonly=True) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, (decay, str(hour), history_days, idle_days))
+            return cur.fetchall()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
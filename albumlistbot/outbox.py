@@ -0,0 +1,156 @@
+import threading
+import time
+
+import flask
+
+from albumlistbot import breaker, metrics, tasks
+from albumlistbot.models import DatabaseError
+from albumlistbot.models import outbox as outbox_model
+
+
+_pending = set()
+_depths = {}
+_backoff = {}
+_lock = threading.Lock()
+_drainer = None
+
+
+def is_pending(app_url):
+    """
+    Whether this worker knows of undelivered events for app_url, in which
+    case new events queue behind them to keep their order
+
+    Ordering is best-effort: a worker learns of events stored by other
+    workers only when it next takes its turn pruning the outbox, and until
+    then it may deliver newer events for the app ahead of them.
+    """
+    return app_url in _pending
+
+
+def store(app_url, json_data):
+    """
+    Keep an event that couldn't be delivered for the drainer to replay
+    (dropped, as before, when the outbox isn't running)
+    """
+    if _drainer is None:
+        metrics.incr('outbox.dropped')
+        return
+    try:
+        outbox_model.add_events([(app_url, json_data.get('team_id'), json_data)])
+    except DatabaseError as e:
+        metrics.incr('outbox.dropped')
+        flask.current_app.logger.error(f'[outbox]: failed to store event for {app_url}: {e}')
+        return
+    with _lock:
+        _pending.add(app_url)
+    metrics.incr('outbox.stored')
+
+
+def send_in_order(app_url, events):
+    """
+    Deliver events oldest first, stopping at the first failure, and return
+    how many were delivered
+    """
+    from albumlistbot import delivery
+    if delivery.supports_batches(app_url):
+        return len(events) - len(delivery.post_batch(app_url, events))
+    for delivered, json_data in enumerate(events):
+        if not delivery.post_event(app_url, json_data):
+            return delivered
+    return len(events)
+
+
+def backing_off(app_url, now):
+    with _lock:
+        return now < _backoff.get(app_url, (0, 0))[0]
+
+
+def back_off(app_url, now, interval, max_backoff):
+    with _lock:
+        delay = min(max(_backoff.get(app_url, (0, 0))[1] * 2, interval), max_backoff)
+        _backoff[app_url] = (now + delay, delay)
+
+
+def drain_app(app_url):
+    """
+    Replay app_url's events a batch at a time while it keeps accepting
+    them, claiming each batch so it's sent outside any transaction
+    """
+    config = flask.current_app.config
+    circuit = breaker.get_breaker(app_url)
+    batch_size = config['OUTBOX_BATCH_SIZE']
+    drained = False
+    while circuit.allow():
+        rows = outbox_model.claim_events(app_url, batch_size, config['OUTBOX_LEASE_SECONDS'])
+        if rows is None:
+            return
+        ids = [row_id for row_id, _ in rows]
+        delivered = send_in_order(app_url, [payload for _, payload in rows]) if rows else 0
+        outbox_model.finish_events(ids[:delivered], ids[delivered:])
+        metrics.incr('outbox.replayed', delivered)
+        with _lock:
+            _depths[app_url] = max(_depths.get(app_url, 0) - delivered, 0)
+        if delivered < len(rows):
+            break
+        if len(rows) < batch_size:
+            drained = True
+            break
+    if drained:
+        with _lock:
+            _pending.discard(app_url)
+            _backoff.pop(app_url, None)
+            _depths.pop(app_url, None)
+        return
+    back_off(app_url, time.monotonic(), config['OUTBOX_INTERVAL'], config['OUTBOX_MAX_BACKOFF'])
+
+
+def drain():
+    """
+    Replay the apps with stored events; the worker whose turn it is to
+    prune the outbox replays every app, the others those they stored
+    """
+    config = flask.current_app.config
+    result = outbox_model.maintain(config['OUTBOX_RETENTION_HOURS'], config['OUTBOX_MAX_PER_APP'])
+    if result is None:
+        with _lock:
+            apps = list(_pending)
+    else:
+        pruned, depths = result
+        if pruned:
+            metrics.incr('outbox.pruned', pruned)
+            flask.current_app.logger.info(f'[outbox]: pruned {pruned} events')
+        with _lock:
+            _depths.clear()
+            _depths.update(depths)
+            _pending.intersection_update(depths)
+            _pending.update(depths)
+        apps = list(depths)
+    now = time.monotonic()
+    for app_url in apps:
+        if not backing_off(app_url, now):
+            drain_app(app_url)
+
+
+def run():
+    interval = flask.current_app.config['OUTBOX_INTERVAL']
+    while True:
+        time.sleep(interval)
+        try:
+            drain()
+        except DatabaseError as e:
+            flask.current_app.logger.error(f'[outbox]: {e}')
+        except Exception:
+            flask.current_app.logger.exception('[outbox]: drain failed')
+
+
+def start_drainer(app):
+    """
+    Start this worker's outbox drainer
+    """
+    global _drainer
+    if _drainer is not None and _drainer.is_alive():
+        return _drainer
+    with app.app_context():
+        _drainer = tasks.spawn(run)
+    metrics.register_gauge('outbox.depth', lambda: sum(_depths.values()))
+    return _drainer
@@ -0,0 +1,132 @@
+import threading
+import time
+
+import flask
+import psycopg2
+import requests
+
+from albumlistbot import breaker, metrics, tasks, usage
+from albumlistbot.models import DatabaseError, get_connection, mapping, try_advisory_lock
+from albumlistbot.models.usage import get_hour_scores
+
+
+LOCK_KEY = 'prewarm'
+
+_last_warmed = {}
+_lock = threading.Lock()
+_scheduler = None
+
+
+def hour_of_week(timestamp):
+    t = time.gmtime(timestamp)
+    return t.tm_wday * 24 + t.tm_hour
+
+
+def record_activity(team_id):
+    """
+    Count a routed request against the current hour of the week (flushed
+    to the usage table with the other usage counters)
+    """
+    usage.record(team_id, 'hour', str(hour_of_week(time.time())))
+
+
+def due_for_warming(now, lead, min_score, cooldown, idle_days, history_days, decay):
+    """
+    Apps of teams whose decayed usage in the hour starting within lead
+    seconds reaches min_score, skipping apps woken in the last cooldown
+    seconds and teams idle for more than idle_days
+    """
+    scores = get_hour_scores(hour_of_week(now + lead), history_days, idle_days, decay)
+    teams = [team_id for team_id, score in scores if score >= min_score]
+    if not teams:
+        return []
+    due = []
+    with _lock:
+        for team_id, app_url in mapping.get_app_urls_for_teams(teams):
+            if not app_url or now - _last_warmed.get(team_id, -cooldown) < cooldown:
+                continue
+            _last_warmed[team_id] = now
+            due.append((team_id, app_url))
+        for team_id in [t for t, warmed in _last_warmed.items() if now - warmed >= cooldown]:
+            del _last_warmed[team_id]
+    return due
+
+
+def wake(team_id, app_url):
+    """
+    Send a request to start the app's dyno; the router boots it whether or
+    not the request is still waiting, so a short timeout is enough
+    """
+    circuit = breaker.get_breaker(app_url)
+    if circuit.state == breaker.OPEN:
+        return
+    flask.current_app.logger.info(f'[prewarm]: waking {app_url} for {team_id}')
+    try:
+        requests.head(app_url, timeout=flask.current_app.config['PREWARM_TIMEOUT'])
+        metrics.incr('prewarm.woken')
+    except requests.exceptions.Timeout:
+        metrics.incr('prewarm.woken')
+    except requests.exceptions.RequestException as e:
+        metrics.incr('prewarm.failed')
+        flask.current_app.logger.info(f'[prewarm]: failed to wake {app_url}: {e}')
+
+
+def is_leader(conn, leader):
+    """
+    Whether this worker holds the prewarm lock, taking it if it's free
+    (a lost connection releases it, so the holder checks it's still up)
+    """
+    if not leader:
+        return try_advisory_lock(conn, LOCK_KEY)
+    try:
+        conn.cursor().execute('SELECT 1;')
+        return True
+    except psycopg2.Error as e:
+        raise DatabaseError(e)
+
+
+def run():
+    """
+    Wake apps each interval while this worker holds the prewarm advisory
+    lock, so only one worker across the deployment wakes apps
+    """
+    config = flask.current_app.config
+    conn = None
+    leader = False
+    while True:
+        time.sleep(config['PREWARM_INTERVAL'])
+        try:
+            if conn is None or conn.closed:
+                conn = get_connection()
+                conn.autocommit = True
+                leader = False
+            leader = is_leader(conn, leader)
+            if not leader:
+                continue
+            due = due_for_warming(
+                time.time(),
+                lead=config['PREWARM_LEAD_MINUTES'] * 60,
+                min_score=config['PREWARM_MIN_SCORE'],
+                cooldown=config['PREWARM_COOLDOWN'],
+                idle_days=config['PREWARM_IDLE_DAYS'],
+                history_days=config['PREWARM_HISTORY_DAYS'],
+                decay=config['PREWARM_DAILY_DECAY'])
+        except DatabaseError as e:
+            flask.current_app.logger.error(f'[prewarm]: {e}')
+            continue
+        for team_id, app_url in due:
+            tasks.submit(wake, team_id, app_url)
+
+
+def start_scheduler(app):
+    """
+    Start this worker's pre-warming scheduler, which learns from the usage
+    table and only wakes apps while elected
+    """
+    global _scheduler
+    if _scheduler is not None and _scheduler.is_alive():
+        return _scheduler
+    with app.app_context():
+        _scheduler = tasks.spawn(run)
+    metrics.register_gauge('prewarm.teams', lambda: len(_last_warmed))
+    return _scheduler
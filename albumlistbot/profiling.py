@@ -0,0 +1,222 @@
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+
+# finished sessions are saved here so any worker can serve their results
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'albumlistbot-profiles')
+
+_session = None
+_lock = threading.Lock()
+
+
+class Session(object):
+    def __init__(self, app, mode, seconds, rate, interval):
+        self.id = uuid.uuid4().hex
+        self.app = app
+        self.mode = mode
+        self.rate = rate
+        self.interval = interval
+        self.started = time.time()
+        self.until = time.monotonic() + seconds
+        self.original_wsgi_app = app.wsgi_app
+        self.profiled = 0
+        self.stats = None
+        self.stacks = Counter()
+        self.saved = False
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return time.monotonic() < self.until
+
+    def add_profile(self, profile):
+        with self._lock:
+            self.profiled += 1
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def add_stacks(self, ignore_thread):
+        frames = sys._current_frames()
+        with self._lock:
+            self.profiled += 1
+            for thread_id, frame in frames.items():
+                if thread_id == ignore_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+class ProfilingMiddleware(object):
+    """
+    Profiles a sample of requests with cProfile while the session lasts
+    """
+    def __init__(self, wsgi_app, session):
+        self.wsgi_app = wsgi_app
+        self.session = session
+
+    def __call__(self, environ, start_response):
+        if not self.session.active:
+            # session expired: take this middleware back out of the request path
+            if self.session.app.wsgi_app is self:
+                self.session.app.wsgi_app = self.wsgi_app
+            return self.wsgi_app(environ, start_response)
+        if random.random() >= self.session.rate:
+            return self.wsgi_app(environ, start_response)
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            response = self.wsgi_app(environ, start_response)
+            try:
+                return list(response)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+        finally:
+            profile.disable()
+            self.session.add_profile(profile)
+
+
+def sample_stacks(session):
+    ignore_thread = threading.get_ident()
+    while session.active and _session is session:
+        session.add_stacks(ignore_thread)
+        time.sleep(session.interval)
+    save(session)
+
+
+def start(app, mode='cprofile', seconds=30, rate=0.1, interval=0.01):
+    """
+    Start profiling this worker: 'cprofile' profiles a rate of requests,
+    'stack' samples every thread's stack each interval
+    """
+    global _session
+    with _lock:
+        stop(app)
+        if mode not in ('cprofile', 'stack'):
+            raise ValueError(f'unknown profiling mode: {mode}')
+        session = _session = Session(app, mode, seconds, rate, interval)
+        if mode == 'cprofile':
+            app.wsgi_app = ProfilingMiddleware(app.wsgi_app, session)
+            timer = threading.Timer(seconds, save, args=(session,))
+            timer.daemon = True
+            timer.start()
+        else:
+            threading.Thread(target=sample_stacks, args=(session,), name='stack-sampler', daemon=True).start()
+        return session
+
+
+def stop(app):
+    """
+    Restore the unprofiled application, keeping the last session's results
+    """
+    session = _session
+    if session is not None:
+        session.until = 0
+        if isinstance(app.wsgi_app, ProfilingMiddleware):
+            app.wsgi_app = session.original_wsgi_app
+        save(session)
+    return session
+
+
+def result_path(profile_id, mode):
+    return os.path.join(PROFILE_DIR, f"{profile_id}.{'stacks' if mode == 'stack' else 'pstats'}")
+
+
+def save(session):
+    """
+    Write a finished session's results to PROFILE_DIR (once)
+    """
+    with session._lock:
+        if session.saved:
+            return
+        session.saved = True
+        if session.mode == 'stack':
+            data = '\n'.join(f'{stack} {count}' for stack, count in session.stacks.most_common()).encode('utf-8')
+        elif session.stats is not None:
+            data = marshal.dumps(session.stats.stats)
+        else:
+            return
+    os.makedirs(PROFILE_DIR, mode=0o700, exist_ok=True)
+    path = result_path(session.id, session.mode)
+    with open(f'{path}.{os.getpid()}.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+
+def find_saved(profile_id=None):
+    """
+    Path of a saved session's results, the latest when profile_id is None
+    """
+    try:
+        names = [name for name in os.listdir(PROFILE_DIR) if name.endswith(('.stacks', '.pstats'))]
+    except FileNotFoundError:
+        return None
+    if profile_id is not None:
+        names = [name for name in names if name.split('.')[0] == profile_id]
+    paths = [os.path.join(PROFILE_DIR, name) for name in names]
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def status():
+    session = _session
+    if session is None:
+        return {'active': False}
+    return {
+        'active': session.active,
+        'mode': session.mode,
+        'started': session.started,
+        'id': session.id,
+        'samples': session.profiled,
+        'saved': session.saved,
+        'pid': os.getpid(),
+    }
+
+
+def format_stats(stats, fmt, limit):
+    if fmt == 'pstats':
+        return marshal.dumps(stats.stats)
+    output = io.StringIO()
+    stats.stream = output
+    stats.sort_stats('cumulative').print_stats(limit)
+    return output.getvalue()
+
+
+def results(fmt='text', limit=50, profile_id=None):
+    """
+    Aggregated results: cProfile as text or marshalled pstats, stacks as
+    collapsed lines (input for flamegraph.pl / speedscope)
+
+    Served from this worker's session when it ran the profile, otherwise
+    from the results saved by whichever worker did once it finished.
+    """
+    session = _session
+    if session is not None and (profile_id == session.id or (profile_id is None and session.active)):
+        with session._lock:
+            if session.mode == 'stack':
+                return '\n'.join(f'{stack} {count}' for stack, count in session.stacks.most_common())
+            if session.stats is None:
+                return ''
+            return format_stats(session.stats, fmt, limit)
+    path = find_saved(profile_id)
+    if path is None:
+        return None
+    if path.endswith('.stacks'):
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+    return format_stats(pstats.Stats(path), fmt, limit)
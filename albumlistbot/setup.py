@@ -1,34 +1,86 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import sys
 
 import flask
+from werkzeug.utils import import_string
 
-from albumlistbot import constants
+from albumlistbot import constants, delivery, logs, outbox, prewarm, startup, usage
+from albumlistbot.models import reset_request_state
+from albumlistbot.models.backends import get_backend
+
+
+class LazyView(object):
+    """
+    View imported on its first request rather than at startup
+    """
+    def __init__(self, import_name):
+        self.import_name = import_name
+        self._view = None
+
+    def __call__(self, *args, **kwargs):
+        if self._view is None:
+            self._view = import_string(self.import_name)
+        return self._view(*args, **kwargs)
 
 
 def add_blueprints(application):
     from albumlistbot.views.api import api_blueprint
     application.register_blueprint(api_blueprint)
-    api_blueprint.config = application.config.copy()
+    api_blueprint.config = application.config
 
-    from albumlistbot.views.heroku import heroku_blueprint
-    application.register_blueprint(heroku_blueprint)
-    heroku_blueprint.config = application.config.copy()
+    application.add_url_rule(
+        '/heroku/oauth', endpoint='heroku.oauth_redirect', methods=['GET'],
+        view_func=LazyView('albumlistbot.views.heroku.oauth_redirect'))
 
     from albumlistbot.views.slack import slack_blueprint
     application.register_blueprint(slack_blueprint)
-    slack_blueprint.config = application.config.copy()
+    slack_blueprint.config = application.config
+
+
+def add_log_handler(app):
+    """
+    Emit app logs to stdout from a listener thread rather than the request thread
+    """
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+    atexit.register(listener.stop)
+    app.logger.addHandler(logs.DeferredQueueHandler(log_queue))
+    app.logger.setLevel(app.config['LOG_LEVEL'])
 
 
 def create_app():
     app = flask.Flask(__name__)
-    if 'DYNO' in os.environ:
-        app.logger.addHandler(logging.StreamHandler(sys.stdout))
-        app.logger.setLevel(logging.DEBUG)
     app.config.from_object(os.environ['APP_SETTINGS'])
+    if 'DYNO' in os.environ:
+        add_log_handler(app)
     if app.config["DISABLE_DATABASE"]:
         app.logger.info(f'[app]: database disabled')
+    backend = get_backend()
+    app.logger.info(f'[app]: using {backend.name} mapping backend')
+    if backend.name == 'postgres' and app.config['CACHE_INVALIDATION']:
+        from albumlistbot.models.listener import start_listener
+        start_listener(app.logger)
+    if backend.name == 'postgres' and app.config['USAGE_FLUSH_SECONDS']:
+        usage.start_flusher(app.logger, app.config['USAGE_FLUSH_SECONDS'], app.config['USAGE_RETENTION_DAYS'])
+    if backend.name == 'postgres' and app.config['MAPPING_SNAPSHOT_SECONDS']:
+        from albumlistbot.models.snapshot import start_refresher
+        start_refresher(app.logger, app.config['MAPPING_SNAPSHOT_SECONDS'])
+    if backend.name == 'postgres' and app.config['OUTBOX']:
+        outbox.start_drainer(app)
+    if backend.name == 'postgres' and app.config['PROCESS_AUTOSCALE']:
+        from albumlistbot.controllers.heroku import start_watcher
+        start_watcher(app)
+    if backend.name == 'postgres' and app.config['PREWARM'] and app.config['USAGE_FLUSH_SECONDS']:
+        prewarm.start_scheduler(app)
+    if app.config['EVENT_BATCHING']:
+        delivery.start_flusher(app)
+    app.before_request(reset_request_state)
     add_blueprints(app)
     app.logger.debug(f'[app]: created with {os.environ["APP_SETTINGS"]}')
+    startup.report(app.logger)
     return app
@@ -0,0 +1,91 @@
+import math
+import os
+import threading
+import time
+
+import flask
+import requests
+from slacker import Slacker
+
+from albumlistbot import cache, metrics
+
+
+_clients = cache.TTLCache('slack_clients', ttl=3600, maxsize=1024)
+_team_info = cache.TTLCache('slack_team_info', ttl=86400, maxsize=1024)
+_user_info = cache.TTLCache('slack_user_info', ttl=300, maxsize=4096)
+_rate_limited = cache.TTLCache('slack_rate_limited', ttl=60, maxsize=1024)
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+class RateLimited(Exception):
+    def __init__(self, method, retry_after):
+        super().__init__(method, retry_after)
+        self.method = method
+        self.retry_after = retry_after
+
+
+def get_session():
+    """
+    Keep-alive session shared by every Slack client in this process
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            _session_pid = os.getpid()
+        return _session
+
+
+def get_client(token):
+    client = _clients.get(token)
+    if client is None:
+        timeout = flask.current_app.config['SLACK_TIMEOUT']
+        client = _clients.set(token, Slacker(token, timeout=timeout, session=get_session()))
+    return client
+
+
+def call(token, method, request):
+    """
+    Run request(client) for a Slack API method, failing fast while Slack
+    has asked (via Retry-After on a 429) for the method to be left alone
+    """
+    key = (token, method)
+    until = _rate_limited.get(key)
+    if until is not None:
+        metrics.incr('slack.rate_limited', method=method)
+        raise RateLimited(method, max(math.ceil(until - time.monotonic()), 1))
+    started = time.monotonic()
+    try:
+        return request(get_client(token)).body
+    except requests.exceptions.HTTPError as e:
+        if e.response is None or e.response.status_code != 429:
+            raise
+        retry_after = int(e.response.headers.get('Retry-After', 1))
+        _rate_limited.set(key, time.monotonic() + retry_after, ttl=retry_after)
+        metrics.incr('slack.rate_limited', method=method)
+        flask.current_app.logger.error(f'[slack]: {method} rate limited for {retry_after}s')
+        raise RateLimited(method, retry_after)
+    finally:
+        metrics.observe('slack.api', time.monotonic() - started, method=method)
+
+
+def team_info(token, team_id=None):
+    """
+    The team's info, cached by team id (not by token, nor evicted when the
+    team's mapping changes) as a team's domain outlives its tokens
+    """
+    info = _team_info.get(team_id) if team_id else None
+    if info is None:
+        info = call(token, 'team.info', lambda client: client.team.info())['team']
+        _team_info.set(info.get('id', team_id), info, ttl=flask.current_app.config['SLACK_TEAM_INFO_TTL'])
+    return info
+
+
+def user_info(token, user_id):
+    info = _user_info.get((token, user_id))
+    if info is None:
+        info = call(token, 'users.info', lambda client: client.users.info(user_id))['user']
+        _user_info.set((token, user_id), info, team=info.get('team_id'), ttl=flask.current_app.config['SLACK_USER_INFO_TTL'])
+    return info
@@ -0,0 +1,83 @@
+import sys
+import time
+
+
+_timings = {}
+_stack = []
+_finder = None
+_started = time.perf_counter()
+
+
+class TimedLoader(object):
+    """
+    Loader proxy recording the time spent executing a module, less the
+    time spent importing its own imports
+    """
+    def __init__(self, loader):
+        self.loader = loader
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        started = time.perf_counter()
+        _stack.append(0.0)
+        try:
+            self.loader.exec_module(module)
+        finally:
+            nested = _stack.pop()
+            elapsed = time.perf_counter() - started
+            _timings[module.__name__] = elapsed - nested
+            if _stack:
+                _stack[-1] += elapsed
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class TimingFinder(object):
+    """
+    Meta path finder wrapping the loaders the other finders return
+    """
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                spec.loader = TimedLoader(spec.loader)
+            return spec
+
+
+def install():
+    """
+    Start timing imports (call before importing the app)
+    """
+    global _finder
+    if _finder is None:
+        _finder = TimingFinder()
+        sys.meta_path.insert(0, _finder)
+
+
+def uninstall():
+    global _finder
+    if _finder is not None:
+        sys.meta_path.remove(_finder)
+        _finder = None
+
+
+def report(logger, top=20):
+    """
+    Log how long the process took to get here and, when installed, the
+    slowest imports
+    """
+    logger.info(f'[startup]: app created in {time.perf_counter() - _started:.3f}s')
+    if _finder is None:
+        return
+    uninstall()
+    total = sum(_timings.values())
+    logger.info(f'[startup]: {len(_timings)} modules imported in {total:.3f}s')
+    for name, seconds in sorted(_timings.items(), key=lambda item: item[1], reverse=True)[:top]:
+        logger.info(f'[startup]: {seconds * 1000:8.1f}ms {name}')
@@ -0,0 +1,69 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+
+from albumlistbot import models
+
+
+_executors = {}
+_executors_pid = None
+_executors_lock = threading.Lock()
+
+
+def get_executor(name='tasks'):
+    """
+    Per-process thread pool: 'tasks' for background work, 'dispatch' for
+    concurrent calls made on behalf of a waiting request
+    """
+    global _executors_pid
+    with _executors_lock:
+        if _executors_pid != os.getpid():
+            _executors.clear()
+            _executors_pid = os.getpid()
+        if name not in _executors:
+            if name == 'dispatch':
+                max_workers = flask.current_app.config.get('DISPATCH_WORKERS', 8)
+            else:
+                max_workers = flask.current_app.config.get('TASK_WORKERS', 4)
+            _executors[name] = ThreadPoolExecutor(max_workers=max_workers)
+        return _executors[name]
+
+
+def in_app_context(func, *args, **kwargs):
+    app = flask.current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            models.reset_request_state()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                app.logger.exception(f'[tasks]: {getattr(func, "__name__", func)} failed')
+                raise
+
+    return run
+
+
+def submit(func, *args, **kwargs):
+    """
+    Run func on the shared background pool within the current application context
+    """
+    return get_executor().submit(in_app_context(func, *args, **kwargs))
+
+
+def dispatch(func, *args, **kwargs):
+    """
+    Run func concurrently on behalf of the current request
+    """
+    return get_executor('dispatch').submit(in_app_context(func, *args, **kwargs))
+
+
+def spawn(func, *args, **kwargs):
+    """
+    Run a long-lived func on its own daemon thread (so it never ties up the pool)
+    """
+    thread = threading.Thread(target=in_app_context(func, *args, **kwargs), daemon=True)
+    thread.start()
+    return thread
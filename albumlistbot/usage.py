@@ -0,0 +1,76 @@
+import atexit
+import datetime
+import threading
+import time
+from collections import Counter
+
+from albumlistbot.models import DatabaseError
+from albumlistbot.models.usage import add_usage, prune_usage
+
+
+PRUNE_SECONDS = 60 * 60
+
+_counts = Counter()
+_lock = threading.Lock()
+_flusher = None
+
+
+def record(team, kind, name):
+    if _flusher is None:
+        return
+    with _lock:
+        _counts[(team, kind, name)] += 1
+
+
+def flush(logger):
+    global _counts
+    with _lock:
+        counts, _counts = _counts, Counter()
+    if not counts:
+        return
+    day = datetime.datetime.utcnow().date()
+    rows = [(team, kind, name, day, count) for (team, kind, name), count in counts.items()]
+    try:
+        add_usage(rows)
+    except DatabaseError as e:
+        logger.error(f'[usage]: failed to flush {len(rows)} counters: {e}')
+        with _lock:
+            _counts.update(counts)
+
+
+def prune(logger, retention_days):
+    try:
+        pruned = prune_usage(retention_days)
+    except DatabaseError as e:
+        logger.error(f'[usage]: failed to prune counters: {e}')
+        return
+    if pruned:
+        logger.info(f'[usage]: pruned {pruned} counters older than {retention_days} days')
+
+
+def run(logger, interval, retention_days):
+    last_prune = 0.0
+    while True:
+        time.sleep(interval)
+        try:
+            flush(logger)
+            if time.monotonic() - last_prune >= PRUNE_SECONDS:
+                last_prune = time.monotonic()
+                prune(logger, retention_days)
+        except Exception:
+            logger.exception('[usage]: flush failed')
+
+
+def start_flusher(logger, interval, retention_days):
+    """
+    Start a daemon thread writing counters to the usage table every interval
+    seconds, and dropping those older than retention_days every hour
+    """
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return _flusher
+    _flusher = threading.Thread(
+        target=run, args=(logger, interval, retention_days), name='usage-flusher', daemon=True)
+    _flusher.start()
+    atexit.register(flush, logger)
+    return _flusher
@@ -1,14 +1,35 @@
+import functools
+import hmac
+
 import flask
 import logging
 
+from albumlistbot import cache, metrics, profiling
 from albumlistbot.controllers import heroku
-from albumlistbot.models import DatabaseError, mapping
+from albumlistbot.models import DatabaseError, mapping, usage
 
 
 api_blueprint = flask.Blueprint(name='api',
                                 import_name=__name__,
                                 url_prefix='/api')
 
+_ping_tokens = cache.TTLCache('ping_tokens', ttl=300, maxsize=4096)
+
+
+def admin_required(func):
+    """
+    Decorator for locking down admin endpoints to requests bearing ADMIN_TOKEN
+    """
+    @functools.wraps(func)
+    def wraps(*args, **kwargs):
+        admin_token = api_blueprint.config['ADMIN_TOKEN']
+        auth = flask.request.headers.get('Authorization', '')
+        if admin_token and hmac.compare_digest(auth, f'Bearer {admin_token}'):
+            return func(*args, **kwargs)
+        flask.current_app.logger.error('[access]: failed admin check')
+        flask.abort(403)
+    return wraps
+
 
 @api_blueprint.after_request
 def after_request(response):
@@ -27,16 +48,102 @@ def api_mappings():
         return flask.jsonify({'text': 'failed'}), 500
 
 
+def conditional_jsonify(data):
+    response = flask.jsonify(data)
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = api_blueprint.config['MAPPING_CACHE_MAX_AGE']
+    return response.make_conditional(flask.request)
+
+
 @api_blueprint.route('/mapping/<team_id>', methods=['GET'])
 def api_map_team_id_to_app_url(team_id):
     try:
-        return flask.jsonify(mapping.get_app_url_for_team(team_id)), 200
+        return conditional_jsonify(mapping.get_app_url_for_team(team_id))
     except DatabaseError as e:
         flask.current_app.logger.error('[db]: failed to get mappings')
         flask.current_app.logger.error(f'[db]: {e}')
         return flask.jsonify({'text': 'failed'}), 500
 
 
+@api_blueprint.route('/mapping', methods=['GET'])
+def api_map_team_ids_to_app_urls():
+    """
+    Batch lookup: /api/mapping?team=T1&team=T2 or /api/mapping?teams=T1,T2
+    """
+    team_ids = flask.request.args.getlist('team')
+    team_ids += [t for arg in flask.request.args.getlist('teams') for t in arg.split(',') if t]
+    team_ids = sorted(set(team_ids))
+    if not team_ids:
+        return flask.jsonify({'text': 'no teams given'}), 400
+    if len(team_ids) > api_blueprint.config['MAPPING_BATCH_LIMIT']:
+        return flask.jsonify({'text': 'too many teams'}), 400
+    try:
+        apps = dict(mapping.get_app_urls_for_teams(team_ids))
+    except DatabaseError as e:
+        flask.current_app.logger.error('[db]: failed to get mappings')
+        flask.current_app.logger.error(f'[db]: {e}')
+        return flask.jsonify({'text': 'failed'}), 500
+    return conditional_jsonify({team_id: apps.get(team_id) for team_id in team_ids})
+
+
+@api_blueprint.route('/metrics', methods=['GET'])
+def api_metrics():
+    return flask.jsonify(metrics.snapshot()), 200
+
+
+@api_blueprint.route('/usage', methods=['GET'])
+@admin_required
+def api_usage():
+    days = flask.request.args.get('days', 7, type=int)
+    team_id = flask.request.args.get('team')
+    try:
+        rows = usage.get_usage(days, team_id)
+    except DatabaseError as e:
+        flask.current_app.logger.error('[db]: failed to get usage')
+        flask.current_app.logger.error(f'[db]: {e}')
+        return flask.jsonify({'text': 'failed'}), 500
+    return flask.jsonify([
+        {'team': team, 'kind': kind, 'name': name, 'count': count}
+        for team, kind, name, count in rows
+    ]), 200
+
+
+@api_blueprint.route('/profile', methods=['POST'])
+@admin_required
+def api_profile_start():
+    args = flask.request.args
+    try:
+        profiling.start(
+            flask.current_app._get_current_object(),
+            mode=args.get('mode', 'cprofile'),
+            seconds=args.get('seconds', 30, type=float),
+            rate=args.get('rate', 0.1, type=float),
+            interval=args.get('interval', 0.01, type=float))
+    except ValueError as e:
+        return flask.jsonify({'text': str(e)}), 400
+    return flask.jsonify(profiling.status()), 200
+
+
+@api_blueprint.route('/profile', methods=['GET'])
+@admin_required
+def api_profile_results():
+    fmt = flask.request.args.get('format', 'text')
+    output = profiling.results(fmt, profile_id=flask.request.args.get('id'))
+    if output is None:
+        return flask.jsonify(profiling.status()), 404
+    if fmt == 'pstats':
+        return flask.Response(output, mimetype='application/octet-stream')
+    return flask.Response(output, mimetype='text/plain')
+
+
+@api_blueprint.route('/profile', methods=['DELETE'])
+@admin_required
+def api_profile_stop():
+    profiling.stop(flask.current_app._get_current_object())
+    return flask.jsonify(profiling.status()), 200
+
+
 @api_blueprint.route('', methods=['GET'])
 def all_endpoints():
     rules = [
@@ -47,12 +154,26 @@ def all_endpoints():
     return flask.jsonify({'api': rules}), 200
 
 
+def get_team_for_ping(slack_token):
+    team = _ping_tokens.get(slack_token)
+    if team is not None:
+        return team
+    team = mapping.get_team_app_heroku_by_slack(slack_token)
+    if team:
+        _ping_tokens.set(slack_token, team, team=team[0], ttl=api_blueprint.config['PING_TOKEN_CACHE_SECONDS'])
+    return team
+
+
 @api_blueprint.route('/ping', methods=['GET'])
 def albumlist_wake():
     slack_token = flask.request.args['token']
-    if flask.current_app.config["DISABLE_DATABASE"]:
-        team_id, app_url, heroku_token = (mapping.get_team_app_by_slack(slack_token), None)
-    else:
-        team_id, app_url, heroku_token = mapping.get_team_app_heroku_by_slack(slack_token)
-    heroku.check_albumlist(team_id, app_url, heroku_token)
+    try:
+        team = get_team_for_ping(slack_token)
+    except DatabaseError as e:
+        flask.current_app.logger.error(f'[db]: {e}')
+        return '', 500
+    if not team:
+        return '', 404
+    team_id, app_url, heroku_token = team
+    heroku.schedule_check_albumlist(team_id, app_url, heroku_token)
     return '', 200
@@ -5,16 +5,12 @@ from albumlistbot import constants
 from albumlistbot.models import DatabaseError, mapping
 
 
-heroku_blueprint = flask.Blueprint(name='heroku',
-                               import_name=__name__,
-                               url_prefix='/heroku')
-
-
-
-@heroku_blueprint.route('/oauth', methods=['GET'])
 def oauth_redirect():
-    client_secret = heroku_blueprint.config['HEROKU_CLIENT_SECRET']
-    csrf = heroku_blueprint.config['CSRF_TOKEN']
+    """
+    Heroku OAuth callback (rarely hit, so only imported on first use)
+    """
+    client_secret = flask.current_app.config['HEROKU_CLIENT_SECRET']
+    csrf = flask.current_app.config['CSRF_TOKEN']
     state = flask.request.args.get('state', '')
     code = flask.request.args.get('code')
     if not state.startswith(csrf):
@@ -39,7 +35,9 @@ def oauth_redirect():
     flask.current_app.logger.debug(f'[heroku]: {team_id} access: {access_token}')
     flask.current_app.logger.debug(f'[heroku]: {team_id} refresh: {refresh_token}')
     try:
-        mapping.set_heroku_and_refresh_token_for_team(team_id, access_token, refresh_token)
+        if not mapping.set_heroku_and_refresh_token_for_team(team_id, access_token, refresh_token):
+            flask.current_app.logger.error(f'[heroku]: {team_id} is not registered')
+            return 'Failed'
     except DatabaseError as e:
         flask.current_app.logger.error(f'[db]: {e}')
         return 'Failed'
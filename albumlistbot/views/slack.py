@@ -1,38 +1,46 @@
 import functools
 import hmac
 import json
+import threading
 import time
-from urllib.parse import urljoin
 
 import flask
 import requests
 
-from albumlistbot import constants
-from albumlistbot.controllers import scrape_links_from_text, heroku, slack
-from albumlistbot.models import DatabaseError, mapping
+from albumlistbot import bulkhead, cache, constants, delivery, logs, metrics, prewarm, slack_client, tasks, usage
+from albumlistbot.controllers import scrape_links_from_text, events, heroku, restore, slack
+from albumlistbot.models import DatabaseError, interactions, mapping
+from albumlistbot.models.backends import get_backend
 
 
 slack_blueprint = flask.Blueprint(name='slack',
                                   import_name=__name__,
                                   url_prefix='/slack')
 
+_responses = cache.TTLCache('command_responses', ttl=60, maxsize=4096)
+INTERACTION_TTL = 600
+
+_interactions = cache.TTLCache('interactions', ttl=INTERACTION_TTL, maxsize=4096)
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
 
 def list_commands(*args, **kwargs):
     return '\n'.join(SLASH_COMMANDS.keys())
 
 
-def get_or_set_album_of_the_day_channel(team_id, form_data, *args, **kwargs):
+def get_or_set_album_of_the_day_channel(team_id, app_url, form_data, heroku_token, *args, **kwargs):
     channel_id = form_data['text'].strip()
     flask.current_app.logger.info(f'[router]: setting AOTD channel for {team_id} to {channel_id}')
-    app_url_or_name, heroku_token = mapping.get_app_and_heroku_token_for_team(team_id)
-    with requests.Session() as s:
-        heroku_token = heroku.is_managed(team_id, app_url_or_name, heroku_token, session=s)
-        if heroku_token:
-            if not channel_id:
-                return heroku.get_config_variable_for_albumlist(app_url_or_name, heroku_token, 'AOTD_CHANNEL_ID', session=s)
-            config_dict = {'AOTD_CHANNEL_ID': channel_id}
-            heroku.set_config_variables_for_albumlist(app_url_or_name, heroku_token, config_dict, session=s)
-            return 'Updated the channel for album of the day'
+    app_url_or_name = app_url
+    s = heroku.get_session()
+    heroku_token = heroku.get_managed_token(team_id, app_url_or_name, heroku_token, session=s, **kwargs)
+    if heroku_token:
+        if not channel_id:
+            return heroku.get_config_variable_for_albumlist(app_url_or_name, heroku_token, 'AOTD_CHANNEL_ID', session=s)
+        config_dict = {'AOTD_CHANNEL_ID': channel_id}
+        heroku.set_config_variables_for_albumlist(app_url_or_name, heroku_token, config_dict, session=s)
+        return 'Updated the channel for album of the day'
     return ''
 
 
@@ -43,24 +51,121 @@ SLASH_COMMANDS = {
     'create': heroku.create_albumlist,
     'check': heroku.check_albumlist,
     'test': slack.test_albumlist,
-    'process_albums': slack.process_albums,
-    'process_attribution': slack.process_attribution,
+    'process_albums': heroku.process_albums,
+    'process_attribution': heroku.process_attribution,
     'process_check': slack.process_check,
-    'process_covers': slack.process_covers,
-    'process_duplicates': slack.process_duplicates,
-    'process_released': slack.process_released,
-    'process_tags': slack.process_tags,
-    'process_unavailable': slack.process_unavailable,
+    'process_covers': heroku.process_covers,
+    'process_duplicates': heroku.process_duplicates,
+    'process_released': heroku.process_released,
+    'process_tags': heroku.process_tags,
+    'process_unavailable': heroku.process_unavailable,
     'aotd_channel': get_or_set_album_of_the_day_channel,
     'clear_cache': slack.clear_cache,
-    'restore': slack.restore_from_url,
+    'restore': restore.restore_from_url,
     'remove': slack.remove_albumlist,
     'scale': heroku.scale_workers,
     'slack': slack.auth_slack,
     'heroku': heroku.auth_heroku,
     'help': list_commands,
     'feedback': slack.send_feedback,
+    'events': events.albumlist_events,
+}
+
+
+# seconds a read-only command's response is reused for the team
+READ_ONLY_COMMANDS = {
+    'count': 60,
+    'url': 300,
+    'name': 300,
+    'aotd_channel': 300,
+}
+# commands that only read when called without an argument
+ARGUMENT_MUTATES = {'url', 'name', 'aotd_channel'}
+MUTATING_COMMANDS = {
+    'create',
+    'remove',
+    'restore',
+    'clear_cache',
+    'process_albums',
+    'process_attribution',
+    'process_covers',
+    'process_duplicates',
+    'process_released',
+    'process_tags',
+    'process_unavailable',
 }
+FAILED_RESPONSES = ('Failed', 'The connection', 'The albumlist', 'No albumlist', 'Missing', 'Team not authorised')
+CHEAP_COMMANDS = {'help', 'url', 'slack', 'heroku', 'events'}
+MANAGED_COMMANDS = {
+    'name',
+    'scale',
+    'aotd_channel',
+}
+
+
+def pre_dispatch(command, team_id, user_id, app_url, slack_token, heroku_token, probe_managed=True):
+    """
+    Run a command's independent prerequisites concurrently: the Slack admin
+    check and, for Heroku-backed commands, the is_managed probe
+
+    Returns whether the user is an admin and extra kwargs for the handler,
+    or False and the reply for the user when Slack or Heroku can't be asked.
+    """
+    admin_check = tasks.dispatch(slack.is_slack_admin, slack_token, user_id)
+    managed_check = None
+    if probe_managed and command in MANAGED_COMMANDS and app_url and heroku_token:
+        managed_check = tasks.dispatch(heroku.is_managed, team_id, app_url, heroku_token, session=heroku.get_session())
+    try:
+        if not admin_check.result():
+            return False, 'Not authorised'
+        if managed_check is None:
+            return True, {}
+        return True, {'managed_heroku_token': managed_check.result()}
+    except slack_client.RateLimited as e:
+        return False, f'Slack is rate limiting, try again in {e.retry_after}s'
+    except requests.exceptions.RequestException as e:
+        flask.current_app.logger.error(f'[router]: pre-dispatch checks failed for {team_id}: {e}')
+        return False, 'Slack is not responding, try again shortly'
+
+
+def is_read_only(command, text):
+    return command in READ_ONLY_COMMANDS and not (command in ARGUMENT_MUTATES and text)
+
+
+def is_mutating(command, text):
+    return command in MUTATING_COMMANDS or (command in ARGUMENT_MUTATES and bool(text))
+
+
+def get_cached_response(team_id, command):
+    cached = _responses.get((team_id, command))
+    if cached is None:
+        return
+    data, mimetype = cached
+    return flask.Response(data, mimetype=mimetype) if mimetype else data
+
+
+def cache_response(team_id, command, response):
+    if isinstance(response, flask.Response):
+        cached = (response.get_data(), response.mimetype)
+    elif isinstance(response, str) and response and not response.startswith(FAILED_RESPONSES):
+        cached = (response, None)
+    else:
+        return
+    _responses.set((team_id, command), cached, team=team_id, ttl=READ_ONLY_COMMANDS[command])
+
+
+def get_command_limits(command, team_id):
+    """
+    Bulkheads for a command: its own group limit and a per-team limit
+    (cheap commands are never held back)
+    """
+    if command in CHEAP_COMMANDS:
+        return []
+    limits = [(f'team:{team_id}', slack_blueprint.config['TEAM_CONCURRENCY'])]
+    name, limit = bulkhead.command_limit(command, slack_blueprint.config['COMMAND_CONCURRENCY'])
+    if name:
+        limits.append((name, limit))
+    return limits
 
 
 def slack_check(func):
@@ -120,6 +225,7 @@ def albumlist_commands():
           /albumlist process_unavailable
           /albumlist clear_cache
           /albumlist aotd_channel #announcements
+          /albumlist events message:links reaction_added
     """
     form_data = flask.request.form.copy()
     team_id = form_data['team_id']
@@ -131,19 +237,134 @@ def albumlist_commands():
         return slack.auth_slack(team_id), 200
     if not slack_token:
         return slack.auth_slack(team_id), 200
-    if not slack.is_slack_admin(slack_token, user_id):
-        return 'Not authorised', 200
     command, *params = text.strip().split(' ')
     form_data['text'] = ' '.join(params)
+    read_only = is_read_only(command, form_data['text'])
+    cached = get_cached_response(team_id, command) if read_only else None
+    is_admin, prefetched = pre_dispatch(
+        command, team_id, user_id, app_url, slack_token, heroku_token, probe_managed=cached is None)
+    if not is_admin:
+        return prefetched, 200
     try:
-        return SLASH_COMMANDS[command](
+        handler = SLASH_COMMANDS[command]
+    except KeyError:
+        return 'No such albumlist command', 200
+    usage.record(team_id, 'command', command)
+    if cached is not None:
+        metrics.incr('commands.cached')
+        return cached, 200
+    mutating = is_mutating(command, form_data['text'])
+    if mutating:
+        _responses.evict_team(team_id)
+    with bulkhead.bulkheads(*get_command_limits(command, team_id)) as acquired:
+        if not acquired:
+            return 'Busy, try again in a moment', 200
+        response = handler(
             team_id=team_id,
             app_url=app_url,
             slack_token=slack_token,
             heroku_token=heroku_token,
-            form_data=form_data), 200
-    except KeyError:
-        return 'No such albumlist command', 200
+            form_data=form_data,
+            **prefetched)
+    if mutating:
+        try:
+            mapping.evict_team_everywhere(team_id)
+        except DatabaseError as e:
+            flask.current_app.logger.error(f'[db]: {e}')
+    if read_only:
+        cache_response(team_id, command, response)
+    return response, 200
+
+
+def interaction_key(team_id, json_data):
+    """
+    Identify an interaction: the prompt's message_ts is shared by double
+    clicks and retries alike, with the action_ts and trigger_id as fallbacks
+    """
+    action = json_data['actions'][0]
+    interaction_id = json_data.get('message_ts') or action.get('action_ts') or json_data.get('trigger_id') or ''
+    return (team_id, json_data['callback_id'], interaction_id)
+
+
+def run_interaction_once(team_id, json_data, in_flight_status, func, *args):
+    """
+    Run an interactive callback's action at most once per interaction, and
+    one at a time per team and callback; duplicates get the original's
+    status (or in_flight_status while it is still running)
+
+    Claims are rows in the interactions table, so this holds across
+    workers; other backends only guard within this worker.
+    """
+    key = interaction_key(team_id, json_data)
+    if get_backend().name != 'postgres':
+        return run_interaction_locally(key, in_flight_status, func, *args)
+    try:
+        claimed, status = interactions.claim_interaction(*key, INTERACTION_TTL)
+    except DatabaseError as e:
+        flask.current_app.logger.error(f'[db]: {e}')
+        return 'Failed'
+    if not claimed:
+        metrics.incr('interactions.duplicate')
+        return status or in_flight_status
+    status = None
+    try:
+        status = func(*args)
+        return status
+    finally:
+        if status is not None and status.startswith(FAILED_RESPONSES):
+            status = None
+        try:
+            interactions.finish_interaction(*key, status)
+        except DatabaseError as e:
+            flask.current_app.logger.error(f'[db]: {e}')
+
+
+def run_interaction_locally(key, in_flight_status, func, *args):
+    status = _interactions.get(key)
+    if status is not None:
+        metrics.incr('interactions.duplicate')
+        return status
+    lock_key = key[:2]
+    with _in_flight_lock:
+        if lock_key in _in_flight:
+            metrics.incr('interactions.duplicate')
+            return in_flight_status
+        _in_flight.add(lock_key)
+    try:
+        status = func(*args)
+        if not status.startswith(FAILED_RESPONSES):
+            _interactions.set(key, status)
+        return status
+    finally:
+        with _in_flight_lock:
+            _in_flight.discard(lock_key)
+
+
+def create_list(team_id):
+    slack_token, heroku_token = mapping.get_tokens_for_team(team_id)
+    if not slack_token:
+        return 'Team not authorised'
+    if not heroku_token:
+        return 'Missing Heroku OAuth'
+    app_name = heroku.create_new_albumlist(team_id, slack_token, heroku_token)
+    if not app_name:
+        return 'Failed'
+    try:
+        mapping.set_mapping_for_team(team_id, app_name)
+    except DatabaseError as e:
+        flask.current_app.logger.error(f'[db]: {e}')
+        return 'Failed'
+    return 'Creating new albumlist...'
+
+
+def delete_list(team_id):
+    try:
+        mapping.delete_from_mapping(team_id)
+        flask.current_app.logger.info(f'[router]: deleted mapping for {team_id}')
+    except DatabaseError as e:
+        flask.current_app.logger.error(f'[db]: {e}')
+        return 'Failed'
+    return 'Unregistered the Albumlist for your Slack team (admins: use `/albumlist slack` to authenticate again)'
 
 
 @slack_blueprint.route('/route', methods=['POST'])
@@ -155,33 +376,12 @@ def route_to_app():
         json_data = json.loads(form_data['payload'])
         team_id = json_data['team']['id']
         callback_id = json_data.get('callback_id', '')
-        if callback_id == f'create_list_{team_id}':
-            if 'yes' in json_data['actions'][0]['name']:
-                slack_token, heroku_token = mapping.get_tokens_for_team(team_id)
-                if not slack_token:
-                    return 'Team not authorised', 200
-                if not heroku_token:
-                    return 'Missing Heroku OAuth', 200
-                app_name = heroku.create_new_albumlist(team_id, slack_token, heroku_token)
-                if not app_name:
-                    return 'Failed', 200
-                try:
-                    mapping.set_mapping_for_team(team_id, app_name)
-                except DatabaseError as e:
-                    flask.current_app.logger.error(f'[db]: {e}')
-                    return 'Failed', 200
-                return 'Creating new albumlist...', 200
-            return 'OK', 200
-        elif callback_id == f'delete_list_{team_id}':
-            if 'yes' in json_data['actions'][0]['name']:
-                try:
-                    mapping.delete_from_mapping(team_id)
-                    flask.current_app.logger.info(f'[router]: deleted mapping for {team_id}')
-                except DatabaseError as e:
-                    flask.current_app.logger.error(f'[db]: {e}')
-                    return 'Failed', 200
-                return 'Unregistered the Albumlist for your Slack team (admins: use `/albumlist slack` to authenticate again)', 200
-            return 'OK', 200
+        if callback_id in (f'create_list_{team_id}', f'delete_list_{team_id}'):
+            if 'yes' not in json_data['actions'][0]['name']:
+                return 'OK', 200
+            if callback_id.startswith('create_list_'):
+                return run_interaction_once(team_id, json_data, 'Creating new albumlist...', create_list, team_id), 200
+            return run_interaction_once(team_id, json_data, 'Unregistering the Albumlist...', delete_list, team_id), 200
     else:
         team_id = form_data['team_id']
     try:
@@ -203,18 +403,21 @@ def route_events_to_app():
     if json_data['token'] != slack_blueprint.config['APP_TOKEN']:
         return '', 200
     team_id = json_data['team_id']
+    usage.record(team_id, 'event', json_data.get('event', {}).get('type', request_type))
     try:
-        app_url, token = mapping.get_app_and_slack_token_for_team(team_id)
+        app_url, event_filter = mapping.get_app_and_event_filter_for_team(team_id)
         if not app_url or not scrape_links_from_text(app_url):
             return '', 200
     except DatabaseError as e:
         flask.current_app.logger.error(f'[db]: {e}')
         return '', 200
-    full_url = urljoin(app_url, 'slack/events')
-    flask.current_app.logger.info(f'[router]: connecting {team_id} to {full_url}...')
-    response = requests.post(full_url, json=json_data)
-    if not response.ok:
-        flask.current_app.logger.error(f'[router]: connection error to {full_url}: {response.status_code}')
+    if not events.should_forward(json_data, event_filter or slack_blueprint.config['EVENT_FILTER_DEFAULT']):
+        metrics.incr('events.dropped')
+        return '', 200
+    metrics.incr('events.forwarded')
+    prewarm.record_activity(team_id)
+    logs.info('[router]: routing event', team=team_id, url=app_url, type=request_type, sample=slack_blueprint.config['LOG_SAMPLE_RATE_EVENTS'])
+    delivery.deliver(app_url, json_data)
     return '', 200
 
 
@@ -231,24 +434,24 @@ def auth():
         team_id = response_json['team_id']
         access_token = response_json['access_token']
         try:
-            if mapping.team_exists(team_id):
-                mapping.set_slack_token_for_team(team_id, access_token)
-                flask.current_app.logger.info(f'[router]: set new token {access_token} for {team_id}')
-                app_url_or_name, heroku_token = mapping.get_app_and_heroku_token_for_team(team_id)
-                with requests.Session() as s:
-                    heroku_token = heroku.is_managed(team_id, app_url_or_name, heroku_token, session=s)
-                    if heroku_token:
-                        config_dict = {
-                            'SLACK_OAUTH_TOKEN': access_token,
-                            'APP_TOKEN_BOT': flask.current_app.config['APP_TOKEN'],
-                            'ALBUMLISTBOT_URL': flask.current_app.config['ALBUMLISTBOT_URL'],
-                        }
-                        heroku.set_config_variables_for_albumlist(app_url_or_name, heroku_token, config_dict, session=s)
-                        flask.current_app.logger.info(f'[router]: updated albumlist with new access token')
-            else:
-                mapping.add_team_with_token(team_id, access_token)
-                flask.current_app.logger.info(f'[router]: added {team_id} with {access_token}')
-            return flask.redirect(slack.get_slack_team_url(access_token))
+            app_url_or_name, heroku_token = mapping.upsert_slack_token_for_team(team_id, access_token)
+            flask.current_app.logger.info(f'[router]: set new token {access_token} for {team_id}')
+            if app_url_or_name and heroku_token:
+                s = heroku.get_session()
+                heroku_token = heroku.is_managed(team_id, app_url_or_name, heroku_token, session=s)
+                if heroku_token:
+                    config_dict = {
+                        'SLACK_OAUTH_TOKEN': access_token,
+                        'APP_TOKEN_BOT': flask.current_app.config['APP_TOKEN'],
+                        'ALBUMLISTBOT_URL': flask.current_app.config['ALBUMLISTBOT_URL'],
+                    }
+                    heroku.set_config_variables_for_albumlist(app_url_or_name, heroku_token, config_dict, session=s)
+                    flask.current_app.logger.info(f'[router]: updated albumlist with new access token')
+            try:
+                return flask.redirect(slack.get_slack_team_url(access_token, team_id))
+            except (slack_client.RateLimited, requests.exceptions.RequestException) as e:
+                flask.current_app.logger.error(f'[router]: failed to get team info for {team_id}: {e}')
+                return flask.redirect('https://slack.com')
         except DatabaseError as e:
             flask.current_app.logger.error(f'[db]: {e}')
             return 'Failed to add team', 500
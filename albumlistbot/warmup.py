@@ -0,0 +1,64 @@
+import time
+
+import requests
+
+from albumlistbot import constants, metrics, slack_client
+from albumlistbot.controllers import heroku
+from albumlistbot.models import DatabaseError, connect_timeout, get_pool, get_pool_size
+from albumlistbot.models.backends import get_backend
+
+
+def warm_database(app):
+    """
+    Open connections in this worker's pools so the first requests don't
+    pay for the connection handshake, giving up on each after
+    WARMUP_TIMEOUT
+    """
+    if app.config['DISABLE_DATABASE'] or get_backend().name != 'postgres':
+        return
+    count = min(app.config['WARMUP_CONNECTIONS'], get_pool_size())
+    for name in ('primary', 'replica'):
+        pool = get_pool(name)
+        if pool is None:
+            continue
+        conns = []
+        try:
+            with connect_timeout(app.config['WARMUP_TIMEOUT']):
+                for _ in range(count):
+                    conns.append(pool.getconn())
+        except DatabaseError as e:
+            app.logger.error(f'[warmup]: failed to connect to {name} database: {e}')
+        finally:
+            for conn, pooled in conns:
+                pool.putconn(conn, pooled)
+        app.logger.info(f'[warmup]: opened {len(conns)} {name} database connections')
+
+
+def warm_https(app):
+    """
+    Open keep-alive connections to Slack and Heroku on the sessions their
+    clients share
+    """
+    timeout = app.config['WARMUP_TIMEOUT']
+    for name, request in (
+            ('slack', lambda: slack_client.get_session().get(constants.SLACK_API_TEST_URL, timeout=timeout)),
+            ('heroku', lambda: heroku.get_session().head(constants.HEROKU_API_URL, timeout=timeout))):
+        try:
+            request()
+        except requests.exceptions.RequestException as e:
+            app.logger.error(f'[warmup]: failed to reach {name}: {e}')
+
+
+def warm(app):
+    """
+    Prepare a freshly started worker before it accepts requests
+    """
+    if not app.config['WARMUP']:
+        return
+    started = time.monotonic()
+    with app.app_context():
+        warm_database(app)
+        warm_https(app)
+    seconds = time.monotonic() - started
+    metrics.observe('startup.warmup', seconds)
+    app.logger.info(f'[warmup]: done in {seconds:.3f}s')
@@ -1,2 +1,8 @@
+import os
+
+if int(os.environ.get('STARTUP_REPORT', '0')):
+    from albumlistbot import startup
+    startup.install()
+
 from albumlistbot.setup import create_app  # NOQA
 application = create_app()
@@ -0,0 +1,56 @@
+"""
+Compare per-query latency of the hot mapping lookups with and without
+server-side prepared statements
+
+    python benchmark_statements.py [iterations]
+"""
+import statistics
+import sys
+import time
+from contextlib import closing
+
+from albumlistbot.models import DatabaseError, get_connection, statements
+
+
+def timed(func, teams, iterations):
+    timings = []
+    for i in range(iterations):
+        team = teams[i % len(teams)]
+        start = time.perf_counter()
+        func(team)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f'{label:>10}: mean {statistics.mean(timings):.3f}ms '
+          f'p50 {statistics.median(timings):.3f}ms p99 {p99:.3f}ms')
+
+
+def main(iterations):
+    with closing(get_connection()) as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT team FROM mapping LIMIT 1000;')
+        teams = [row[0] for row in cur.fetchall()] or ['T00000000']
+        sql = statements.STATEMENTS['mapping_by_team'].replace('$1', '%s') + ';'
+
+        def plain(team):
+            cur.execute(sql, (team,))
+            cur.fetchone()
+
+        def prepared(team):
+            statements.execute(conn, 'mapping_by_team', (team,)).fetchone()
+
+        print(f'{iterations} lookups over {len(teams)} teams')
+        report('plain', timed(plain, teams, iterations))
+        report('prepared', timed(prepared, teams, iterations))
+        conn.rollback()
+
+
+if __name__ == '__main__':
+    try:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
+    except DatabaseError as e:
+        print(f'[db]: ERROR - {e}')
@@ -21,6 +21,70 @@ class Config(object):
     ADD_TO_SLACK_URL = os.environ.get('ADD_TO_SLACK_URL')
     SLACK_SIGNING_SECRET = os.environ.get('SLACK_SIGNING_SECRET')
     DISABLE_DATABASE = bool(int(os.environ.get("DISABLE_DATABASE", "0")))
+    MAPPING_CACHE_MAX_AGE = int(os.environ.get('MAPPING_CACHE_MAX_AGE', '60'))
+    MAPPING_BATCH_LIMIT = int(os.environ.get('MAPPING_BATCH_LIMIT', '100'))
+    TASK_WORKERS = int(os.environ.get('TASK_WORKERS', '4'))
+    DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', '8'))
+    PING_COALESCE_SECONDS = int(os.environ.get('PING_COALESCE_SECONDS', '30'))
+    PING_TOKEN_CACHE_SECONDS = int(os.environ.get('PING_TOKEN_CACHE_SECONDS', '300'))
+    CACHE_INVALIDATION = bool(int(os.environ.get('CACHE_INVALIDATION', '1')))
+    MAPPING_SNAPSHOT_PATH = os.environ.get('MAPPING_SNAPSHOT_PATH', '/tmp/albumlistbot-mapping.snapshot')
+    MAPPING_SNAPSHOT_SECONDS = int(os.environ.get('MAPPING_SNAPSHOT_SECONDS', '300'))
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    LOG_SAMPLE_RATE_EVENTS = float(os.environ.get('LOG_SAMPLE_RATE_EVENTS', '0.1'))
+    COMMAND_CONCURRENCY = os.environ.get('COMMAND_CONCURRENCY', 'process_*:2,create:1,restore:1,scale:1,*:8')
+    TEAM_CONCURRENCY = int(os.environ.get('TEAM_CONCURRENCY', '2'))
+    USAGE_FLUSH_SECONDS = int(os.environ.get('USAGE_FLUSH_SECONDS', '60'))
+    USAGE_RETENTION_DAYS = int(os.environ.get('USAGE_RETENTION_DAYS', '90'))
+    ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+    PROCESS_AUTOSCALE = bool(int(os.environ.get('PROCESS_AUTOSCALE', '0')))
+    PROCESS_SCALE_UP = int(os.environ.get('PROCESS_SCALE_UP', '2'))
+    PROCESS_SCALE_DOWN = int(os.environ.get('PROCESS_SCALE_DOWN', '1'))
+    PROCESS_CHECK_INTERVAL = int(os.environ.get('PROCESS_CHECK_INTERVAL', '30'))
+    PROCESS_SCALE_TIMEOUT = int(os.environ.get('PROCESS_SCALE_TIMEOUT', '3600'))
+    PROCESS_SCALE_RETRIES = int(os.environ.get('PROCESS_SCALE_RETRIES', '5'))
+    HEROKU_TIMEOUT = float(os.environ.get('HEROKU_TIMEOUT', '10'))
+    PROCESS_IDLE_REGEX = os.environ.get('PROCESS_IDLE_REGEX', r'^\s*(0\b|no\b|none|idle|complete|finished)')
+    EVENT_TIMEOUT = float(os.environ.get('EVENT_TIMEOUT', '1.5'))
+    EVENT_FILTER_DEFAULT = os.environ.get(
+        'EVENT_FILTER_DEFAULT', 'message:links,message:hashtags,reaction_added,reaction_removed,link_shared')
+    EVENT_BATCHING = bool(int(os.environ.get('EVENT_BATCHING', '0')))
+    EVENT_BATCH_SIZE = int(os.environ.get('EVENT_BATCH_SIZE', '20'))
+    EVENT_BATCH_WAIT_MS = int(os.environ.get('EVENT_BATCH_WAIT_MS', '50'))
+    OUTBOX = bool(int(os.environ.get('OUTBOX', '1')))
+    OUTBOX_INTERVAL = int(os.environ.get('OUTBOX_INTERVAL', '15'))
+    OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+    OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', '300'))
+    OUTBOX_MAX_BACKOFF = int(os.environ.get('OUTBOX_MAX_BACKOFF', '600'))
+    OUTBOX_RETENTION_HOURS = int(os.environ.get('OUTBOX_RETENTION_HOURS', '72'))
+    OUTBOX_MAX_PER_APP = int(os.environ.get('OUTBOX_MAX_PER_APP', '10000'))
+    RESTORE_CHUNK_SIZE = int(os.environ.get('RESTORE_CHUNK_SIZE', '500'))
+    RESTORE_PARALLELISM = int(os.environ.get('RESTORE_PARALLELISM', '3'))
+    RESTORE_TIMEOUT = float(os.environ.get('RESTORE_TIMEOUT', '30'))
+    RESTORE_PROGRESS_SECONDS = int(os.environ.get('RESTORE_PROGRESS_SECONDS', '30'))
+    RESTORE_DEDUPE_ROWS = int(os.environ.get('RESTORE_DEDUPE_ROWS', '100000'))
+    RESTORE_MAX_BYTES = int(os.environ.get('RESTORE_MAX_BYTES', str(50 * 1024 * 1024)))
+    RESTORE_MAX_SECONDS = int(os.environ.get('RESTORE_MAX_SECONDS', '900'))
+    SLACK_TIMEOUT = float(os.environ.get('SLACK_TIMEOUT', '2'))
+    SLACK_TEAM_INFO_TTL = int(os.environ.get('SLACK_TEAM_INFO_TTL', '86400'))
+    SLACK_USER_INFO_TTL = int(os.environ.get('SLACK_USER_INFO_TTL', '300'))
+    STARTUP_REPORT = bool(int(os.environ.get('STARTUP_REPORT', '0')))
+    WARMUP = bool(int(os.environ.get('WARMUP', '1')))
+    WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', '2'))
+    WARMUP_TIMEOUT = float(os.environ.get('WARMUP_TIMEOUT', '2.0'))
+    BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', '20'))
+    BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+    BREAKER_FAILURE_RATE = float(os.environ.get('BREAKER_FAILURE_RATE', '0.5'))
+    BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', '30'))
+    PREWARM = bool(int(os.environ.get('PREWARM', '1')))
+    PREWARM_INTERVAL = int(os.environ.get('PREWARM_INTERVAL', '60'))
+    PREWARM_LEAD_MINUTES = int(os.environ.get('PREWARM_LEAD_MINUTES', '10'))
+    PREWARM_MIN_SCORE = float(os.environ.get('PREWARM_MIN_SCORE', '2'))
+    PREWARM_COOLDOWN = int(os.environ.get('PREWARM_COOLDOWN', '1500'))
+    PREWARM_IDLE_DAYS = int(os.environ.get('PREWARM_IDLE_DAYS', '14'))
+    PREWARM_DAILY_DECAY = float(os.environ.get('PREWARM_DAILY_DECAY', '0.9'))
+    PREWARM_HISTORY_DAYS = int(os.environ.get('PREWARM_HISTORY_DAYS', '56'))
+    PREWARM_TIMEOUT = float(os.environ.get('PREWARM_TIMEOUT', '2'))
 
 
 class ProductionConfig(Config):
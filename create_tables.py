@@ -1,9 +1,19 @@
 from albumlistbot.models import DatabaseError
-from albumlistbot.models.mapping import create_mapping_table
+from albumlistbot.models.autoscale import create_autoscale_table
+from albumlistbot.models.backends import get_backend
+from albumlistbot.models.interactions import create_interactions_table
+from albumlistbot.models.mapping import add_events_column, create_mapping_table
+from albumlistbot.models.outbox import create_outbox_table
+from albumlistbot.models.usage import create_usage_table
 
 
 if __name__ == '__main__':
-    try:
-        create_mapping_table()
-    except DatabaseError as e:
-        print(f'[db]: ERROR - {e}')
\ No newline at end of file
+    steps = [create_mapping_table]
+    if get_backend().name == 'postgres':
+        steps += [add_events_column, create_usage_table, create_outbox_table, create_autoscale_table,
+                  create_interactions_table]
+    for step in steps:
+        try:
+            step()
+        except DatabaseError as e:
+            print(f'[db]: ERROR - {e}')
\ No newline at end of file
@@ -1,2 +1,2 @@
 #!/bin/bash
-gunicorn -b 0.0.0.0:$PORT application:application --log-file=-
\ No newline at end of file
+gunicorn -c gunicorn.conf.py -b 0.0.0.0:$PORT application:application --log-file=-
\ No newline at end of file
@@ -0,0 +1,13 @@
+import os
+
+
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+
+
+def post_worker_init(worker):
+    """
+    Warm the worker up before it is marked ready to serve requests
+    """
+    from albumlistbot import warmup
+    warmup.warm(worker.wsgi)
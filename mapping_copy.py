@@ -0,0 +1,41 @@
+"""
+Stream the mapping table in or out with COPY
+
+    python mapping_copy.py export backup.csv
+    python mapping_copy.py import backup.bin --format binary
+    python mapping_copy.py export - | gzip > backup.csv.gz
+"""
+import argparse
+import sys
+
+from albumlistbot.models import DatabaseError
+from albumlistbot.models.mapping import export_mapping, import_mapping
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or import the mapping table')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path', help='file to write or read, - for stdout/stdin')
+    parser.add_argument('--format', choices=['csv', 'binary'], default='csv')
+    args = parser.parse_args()
+    try:
+        if args.command == 'export':
+            if args.path == '-':
+                export_mapping(sys.stdout.buffer, args.format)
+            else:
+                with open(args.path, 'wb') as f:
+                    export_mapping(f, args.format)
+        else:
+            if args.path == '-':
+                count = import_mapping(sys.stdin.buffer, args.format)
+            else:
+                with open(args.path, 'rb') as f:
+                    count = import_mapping(f, args.format)
+            print(f'[db]: imported {count} teams', file=sys.stderr)
+    except DatabaseError as e:
+        print(f'[db]: ERROR - {e}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import hmac
+import os
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+os.environ.setdefault('APP_SETTINGS', 'config.TestingConfig')
+os.environ['MAPPING_BACKEND'] = 'sqlite'
+
+from albumlistbot import cache  # NOQA
+from albumlistbot.models.backends import SQLiteBackend, set_backend  # NOQA
+from albumlistbot.setup import create_app  # NOQA
+
+
+SIGNING_SECRET = 'test-signing-secret'
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'mapping.sqlite3'))
+    set_backend(backend)
+    cache.clear_all()
+    yield backend
+    set_backend(None)
+    cache.clear_all()
+
+
+@pytest.fixture
+def app(backend):
+    app = create_app()
+    app.config['SLACK_SIGNING_SECRET'] = SIGNING_SECRET
+    app.config['ADD_TO_SLACK_URL'] = 'https://slack.example/add'
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def signed_headers(body, secret=SIGNING_SECRET):
+    timestamp = str(int(time.time()))
+    digest = hmac.new(secret.encode(), f'v0:{timestamp}:{body}'.encode(), 'sha256').hexdigest()
+    return {
+        'X-Slack-Request-Timestamp': timestamp,
+        'X-Slack-Signature': f'v0={digest}',
+        'Content-Type': 'application/x-www-form-urlencoded',
+    }
+
+
+@pytest.fixture
+def slash(client):
+    """
+    Post a signed /albumlist command as a Slack user
+    """
+    def post(text, team_id='T1', user_id='U1', secret=SIGNING_SECRET):
+        body = urlencode({
+            'team_id': team_id,
+            'user_id': user_id,
+            'text': text,
+            'response_url': 'https://hooks.slack.example/response',
+        })
+        return client.post('/slack/albumlist', data=body, headers=signed_headers(body, secret))
+    return post
@@ -0,0 +1,63 @@
+import pytest
+
+from albumlistbot import slack_client
+from albumlistbot.controllers import slack
+from albumlistbot.models import mapping
+
+
+@pytest.fixture
+def admin(monkeypatch):
+    monkeypatch.setattr(slack, 'is_slack_admin', lambda token, user_id: True)
+
+
+@pytest.fixture
+def team(backend):
+    mapping.add_team_with_token('T1', 'xoxb-1')
+    mapping.set_mapping_for_team('T1', 'https://list.example')
+
+
+def test_bad_signature_is_rejected(slash, team):
+    assert slash('help', secret='wrong').status_code == 403
+
+
+def test_unknown_team_is_asked_to_authenticate(slash, backend):
+    response = slash('help', team_id='T404')
+    assert response.status_code == 200
+    assert response.get_json()['text'] == 'Click the link to authenticate Albumlistbot'
+
+
+def test_non_admin(slash, team, monkeypatch):
+    monkeypatch.setattr(slack, 'is_slack_admin', lambda token, user_id: False)
+    assert slash('help').get_data(as_text=True) == 'Not authorised'
+
+
+def test_rate_limited_admin_check(slash, team, monkeypatch):
+    def rate_limited(token, user_id):
+        raise slack_client.RateLimited('users.info', 7)
+    monkeypatch.setattr(slack, 'is_slack_admin', rate_limited)
+    assert slash('help').get_data(as_text=True) == 'Slack is rate limiting, try again in 7s'
+
+
+def test_help(slash, team, admin):
+    assert 'aotd_channel' in slash('help').get_data(as_text=True).split('\n')
+
+
+def test_unknown_command(slash, team, admin):
+    assert slash('dance').get_data(as_text=True) == 'No such albumlist command'
+
+
+def test_url(slash, team, admin):
+    assert slash('url').get_data(as_text=True) == 'https://list.example'
+
+
+def test_set_url_replaces_cached_url(slash, team, admin):
+    assert slash('url').get_data(as_text=True) == 'https://list.example'
+    response = slash('url https://other.example')
+    assert response.get_data(as_text=True) == 'Registered your Slack team with the provided Albumlist'
+    assert mapping.get_app_url_for_team('T1') == 'https://other.example'
+    assert slash('url').get_data(as_text=True) == 'https://other.example'
+
+
+def test_url_without_albumlist(slash, backend, admin):
+    mapping.add_team_with_token('T1', 'xoxb-1')
+    assert slash('url').get_data(as_text=True).startswith('No albumlist mapped to this team')
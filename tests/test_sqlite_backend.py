@@ -0,0 +1,61 @@
+import pytest
+
+from albumlistbot.models import DatabaseError
+
+
+def test_insert_and_get(backend):
+    backend.insert('T1', token='xoxb-1')
+    assert backend.get('T1', ('team', 'token', 'app')) == ('T1', 'xoxb-1', '')
+    assert backend.get_by_token('xoxb-1', ('team',)) == ('T1',)
+    assert backend.exists('T1')
+    assert backend.get('T2', ('team',)) is None
+    assert not backend.exists('T2')
+
+
+def test_insert_existing_team(backend):
+    backend.insert('T1', token='xoxb-1')
+    with pytest.raises(DatabaseError, match='already exists'):
+        backend.insert('T1', token='xoxb-2')
+
+
+def test_update_returning(backend):
+    backend.insert('T1', token='xoxb-1')
+    row = backend.update('T1', returning=('app', 'token'), app='https://list.example')
+    assert row == ('https://list.example', 'xoxb-1')
+    assert backend.update('T1', heroku='h-1') is None
+    assert backend.get('T1', ('heroku',)) == ('h-1',)
+
+
+def test_upsert(backend):
+    assert backend.upsert('T1', ('app', 'token'), token='xoxb-1') == ('', 'xoxb-1')
+    backend.update('T1', app='https://list.example')
+    assert backend.upsert('T1', ('app', 'token'), token='xoxb-2') == ('https://list.example', 'xoxb-2')
+    assert len(backend.all(('team',))) == 1
+
+
+def test_get_many(backend):
+    for team in ('T1', 'T2', 'T3'):
+        backend.insert(team, app=f'https://{team.lower()}.example')
+    rows = backend.get_many(['T1', 'T3', 'T4'], ('team', 'app'))
+    assert sorted(rows) == [('T1', 'https://t1.example'), ('T3', 'https://t3.example')]
+    assert backend.get_many([], ('team',)) == []
+
+
+def test_delete_and_reset(backend):
+    backend.insert('T1')
+    backend.insert('T2')
+    backend.delete('T1')
+    assert backend.all(('team',)) == [('T2',)]
+    backend.reset()
+    assert backend.all(('team',)) == []
+
+
+def test_unknown_column(backend):
+    with pytest.raises(DatabaseError):
+        backend.get('T1', ('team', 'password'))
+
+
+def test_create_table_is_idempotent(backend):
+    backend.insert('T1', events='message:links')
+    backend.create_table()
+    assert backend.get('T1', ('events',)) == ('message:links',)